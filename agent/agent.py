@@ -1,26 +1,102 @@
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import streamlit as st
 from langchain_openai import ChatOpenAI
 from langchain_openai import OpenAIEmbeddings
 from langgraph.graph import MessagesState
 from langgraph.constants import START, END
 from langgraph.graph import StateGraph
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.config import get_config
+from langchain_core.runnables import RunnableLambda
 from langchain_core.runnables.graph import CurveStyle
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, AIMessageChunk
+from langchain_core.utils.json import parse_partial_json
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 try:
-    from agent.utils.diagram_helper import generate, check_modules
+    from agent.utils.diagram_helper import check_modules, build_code
+    from agent.utils.metrics_helper import instrument, record, timed, trace_request, start_metrics_server
+    from agent.utils.client_helper import singleton, get_http_client, get_async_http_client
+    from agent.utils.symbol_index import get_symbol_index
     from agent.utils.qdrant_helper import QdrantHandler
+    from agent.utils.import_repair import repair_imports
+    from agent.utils.retrieval_helper import LexicalIndex, DocumentationRetriever
+    from agent.utils.embedding_cache import CachedEmbeddings
+    from agent.utils.render_pool import RenderPool, RENDER_WORKERS, RENDER_TIMEOUT, RENDER_QUEUE_SIZE
+    from agent.utils.render_cache import RenderCache, RENDER_CACHE_ENTRIES
+    from agent.utils.response_cache import ResponseCache, RESPONSE_CACHE_THRESHOLD, RESPONSE_CACHE_TTL, RESPONSE_CACHE_ENTRIES
+    from agent.utils.lint_helper import lint_body_code as lint_code
+    from agent.utils.edit_helper import apply_edits, EditError
+    from agent.utils.context_helper import build_context, CONTEXT_TOKEN_BUDGET
+    from agent.utils.checkpoint_helper import SQLiteCheckpointer, CHECKPOINT_PATH, CHECKPOINT_TTL, CHECKPOINT_MAX_THREADS, CHECKPOINT_MAX_PER_THREAD
 except:
-    from utils.diagram_helper import generate, check_modules
+    from utils.diagram_helper import check_modules, build_code
+    from utils.metrics_helper import instrument, record, timed, trace_request, start_metrics_server
+    from utils.client_helper import singleton, get_http_client, get_async_http_client
+    from utils.symbol_index import get_symbol_index
     from utils.qdrant_helper import QdrantHandler
+    from utils.import_repair import repair_imports
+    from utils.retrieval_helper import LexicalIndex, DocumentationRetriever
+    from utils.embedding_cache import CachedEmbeddings
+    from utils.render_pool import RenderPool, RENDER_WORKERS, RENDER_TIMEOUT, RENDER_QUEUE_SIZE
+    from utils.render_cache import RenderCache, RENDER_CACHE_ENTRIES
+    from utils.response_cache import ResponseCache, RESPONSE_CACHE_THRESHOLD, RESPONSE_CACHE_TTL, RESPONSE_CACHE_ENTRIES
+    from utils.lint_helper import lint_body_code as lint_code
+    from utils.edit_helper import apply_edits, EditError
+    from utils.context_helper import build_context, CONTEXT_TOKEN_BUDGET
+    from utils.checkpoint_helper import SQLiteCheckpointer, CHECKPOINT_PATH, CHECKPOINT_TTL, CHECKPOINT_MAX_THREADS, CHECKPOINT_MAX_PER_THREAD
 load_dotenv()
 
 MODEL = st.secrets.get("OPENAI_MODEL")
+# Cheaper, low temperature model for repair iterations, the primary model by default
+REPAIR_MODEL = st.secrets.get("OPENAI_REPAIR_MODEL", MODEL)
+REPAIR_TEMPERATURE = st.secrets.get("OPENAI_REPAIR_TEMPERATURE", 0)
+# Assistant calls allowed to fix errors in a single turn, the last one escalates to the primary model
+REPAIR_BUDGET = st.secrets.get("REPAIR_BUDGET", 3)
 API_KEY = st.secrets.get("OPENAI_KEY")
 EMBEDDING_MODEL = st.secrets.get("OPENAI_EMBEDDING_MODEL")
 EMBEDDING_SIZE = st.secrets.get("OPENAI_EMBEDDING_SIZE")
+# Answer documentation lookups from the local lexical index only, without Qdrant or the embeddings API
+RETRIEVAL_OFFLINE = st.secrets.get("RETRIEVAL_OFFLINE", False)
+RENDER_WORKERS = st.secrets.get("RENDER_WORKERS", RENDER_WORKERS)
+RENDER_TIMEOUT = st.secrets.get("RENDER_TIMEOUT", RENDER_TIMEOUT)
+RENDER_QUEUE_SIZE = st.secrets.get("RENDER_QUEUE_SIZE", RENDER_QUEUE_SIZE)
+RENDER_MEMORY_LIMIT_MB = st.secrets.get("RENDER_MEMORY_LIMIT_MB", 1024)
+RENDER_CACHE_ENTRIES = st.secrets.get("RENDER_CACHE_ENTRIES", RENDER_CACHE_ENTRIES)
+# In the app, render a low resolution preview first and the full-quality image in the background.
+# Other callers (invoke, ainvoke, the LangGraph server) always get the full-quality image
+RENDER_PREVIEW = st.secrets.get("RENDER_PREVIEW", True)
+CONTEXT_TOKEN_BUDGET = st.secrets.get("CONTEXT_TOKEN_BUDGET", CONTEXT_TOKEN_BUDGET)
+CHECKPOINT_PATH = st.secrets.get("CHECKPOINT_PATH", CHECKPOINT_PATH)
+CHECKPOINT_TTL = st.secrets.get("CHECKPOINT_TTL", CHECKPOINT_TTL)
+CHECKPOINT_MAX_THREADS = st.secrets.get("CHECKPOINT_MAX_THREADS", CHECKPOINT_MAX_THREADS)
+CHECKPOINT_MAX_PER_THREAD = st.secrets.get("CHECKPOINT_MAX_PER_THREAD", CHECKPOINT_MAX_PER_THREAD)
+# Generate this many candidates concurrently for the first version of a turn and keep the first that renders
+SPECULATIVE_CANDIDATES = st.secrets.get("SPECULATIVE_CANDIDATES", 1)
+# Answer near-duplicate first prompts from earlier validated responses, without calling the LLM
+RESPONSE_CACHE = st.secrets.get("RESPONSE_CACHE", False)
+RESPONSE_CACHE_THRESHOLD = st.secrets.get("RESPONSE_CACHE_THRESHOLD", RESPONSE_CACHE_THRESHOLD)
+RESPONSE_CACHE_TTL = st.secrets.get("RESPONSE_CACHE_TTL", RESPONSE_CACHE_TTL)
+RESPONSE_CACHE_ENTRIES = st.secrets.get("RESPONSE_CACHE_ENTRIES", RESPONSE_CACHE_ENTRIES)
+# Serve Prometheus metrics on this port when set
+METRICS_PORT = st.secrets.get("METRICS_PORT", None)
+# Warm up also connects to Qdrant and builds the OpenAI clients
+WARM_UP_REMOTE = st.secrets.get("WARM_UP_REMOTE", False)
+
+class CodeEdit(BaseModel):
+    """
+    Search and replace edit of the last working body_code.
+
+    Attributes:
+        search (str): Lines of the last working body_code to replace, empty to append to the diagram block.
+        replace (str): The lines that replace them, empty to remove them.
+    """
+    search: str = Field(..., description="Exact lines of the last working body_code to replace. Empty to append new lines at the end of the diagram block.")
+    replace: str = Field(..., description="The lines that replace the searched lines. Empty to remove them.")
 
 class DiagramData(BaseModel):
     """
@@ -30,20 +106,28 @@ class DiagramData(BaseModel):
         import_code (str): The import statements required for the diagram.
         body_code (str): The code that defines the diagram structure.
         ai_response (str): The AI-generated response or explanation.
+        edits (list[CodeEdit]): Edits of the last working body_code, used instead of body_code for updates.
     """
     import_code: str = Field(..., description="The import statements required for the diagram.")
     body_code: str = Field(..., description="The code that defines the diagram structure.")
     ai_response: str = Field(..., description="The AI-generated response or explanation.")
+    edits: list[CodeEdit] = Field(default_factory=list, description="Edits of the last working body_code. Only used when body_code is empty.")
 
 class State(MessagesState):
     import_code: str
     body_code: str
     python_body_code: str
     image_path: str
+    full_image_path: str
     error_messages: list[str]
+    import_issues: list[dict]
+    lint_issues: list[dict]
+    repair_attempts: int
+    cache_prompt: str
+    working_import_code: str
+    working_body_code: str
 
-def assistant(state: State):
-    MODEL_SYSTEM_MESSAGE = """
+MODEL_SYSTEM_MESSAGE = """
     You are a helpful assistant that generates Cloud Architecture Diagrams (AWS, GCP, Azure) based on user input.
 
     Your responsibilities:
@@ -54,30 +138,30 @@ def assistant(state: State):
     5. After successful diagram generation, confirm completion and provide a description of the architecture shown in the diagram.
 
     Output format:
-    Always return exactly three fields:
+    Always return these four fields:
     - `import_code` → contains only the necessary Python imports. **No comments.**  
     - `body_code` → contains only the diagram structure code. **No comments.**  
     - `ai_response` → a natural-language response for the user. **Never reveal or describe code, imports, or implementation details.**
+    - `edits` → a list of search/replace edits of the last working `body_code`. Only for an update of an existing diagram, with `body_code` empty; otherwise an empty list.
 
     Important constraints:
     - Only generate `import_code` and `body_code` when the user explicitly requests diagram/image generation or an update.  
     - The `ai_response` must be natural, e.g., “Here’s the updated diagram based on your input.”  
     - Never explain how the code works or how to run it.  
     - All code must only appear inside `import_code` and `body_code`.  
-    - `import_code` must always begin with:  
+    - When you return the full code, `import_code` must always begin with:  
     `from diagrams import Diagram`  
     - `body_code` must always begin with:  
     `with Diagram("Diagram name", show=False, filename=filename_value, outformat="png", graph_attr=graph_attr_value):`  
         - Use the existing variable `filename_value` (do not redefine it).  
         - Use the existing variable `graph_attr_value` (do not redefine it).  
     - If the user requests an **adjustment or update**, you may reuse and build upon the last provided `import_code` and `body_code` instead of starting from scratch.  
+    - For an **adjustment or update** of an existing diagram, prefer returning `edits` instead of the full code:  
+        - Leave `body_code` empty and put only the new imports in `import_code` (or leave it empty).  
+        - Each edit replaces the exact lines in `search` of the last working `body_code` with the lines in `replace`.  
+        - Use an empty `search` to add new lines at the end of the diagram block, and an empty `replace` to remove lines.  
 
-    Context:
-    This is the last working `import_code` (may be empty):  
-    {import_code}  
-
-    This is the last working `body_code` (may be empty):  
-    {body_code}  
+    The last working `import_code` and `body_code` are given in the final system message of the conversation.
 
     Examples of good responses:
 
@@ -100,21 +184,252 @@ def assistant(state: State):
 
     ai_response_example = "The diagram has been generated successfully. This AWS architecture uses an ELB to distribute traffic across five EC2 instances, which connect to a central RDS database, providing scalability, high availability, and managed data storage."
     """
-    
+
+# Kept out of MODEL_SYSTEM_MESSAGE and sent last, so the instructions stay a stable, cacheable prefix
+CONTEXT_MESSAGE = """
+    Context:
+    This is the last working `import_code` (may be empty):  
+    {import_code}  
+
+    This is the last working `body_code` (may be empty):  
+    {body_code}  
+    """
+
+def _assistant_input(state: State):
     import_code = state.get("import_code", "")
     body_code = state.get("body_code", "")
 
-    system_msg = MODEL_SYSTEM_MESSAGE.format(import_code=import_code, body_code=body_code)
+    context_msg = CONTEXT_MESSAGE.format(import_code=import_code, body_code=body_code)
+    return build_context(MODEL_SYSTEM_MESSAGE, context_msg, state["messages"], max_tokens=CONTEXT_TOKEN_BUDGET)
 
-    response = model.with_structured_output(DiagramData).invoke([SystemMessage(content=system_msg)]+state["messages"])
+FULL_REGENERATION_MESSAGE = """
+    Your edits could not be applied to the last working code: {error}
+    Return the complete `import_code` and `body_code` instead of `edits`.
+    """
+
+def _assistant_output(response: DiagramData, state: State, token_counts, allow_edits=True):
     import_code = response.import_code
     body_code = response.body_code
     ai_response = response.ai_response
-    return {"messages": [AIMessage(content=ai_response)],
+    if allow_edits and response.edits and not body_code:
+        # Incremental update: apply the edits locally instead of having the model re-emit the code
+        import_code, body_code = apply_edits(state.get("import_code", ""), state.get("body_code", ""),
+                                             response.import_code, response.edits)
+    return {"messages": [AIMessage(content=ai_response, response_metadata={"token_counts": token_counts})],
             "import_code": import_code,
             "body_code": body_code
             }
 
+def _model_response(result):
+    """Unpack the include_raw output of the structured model and record its token usage."""
+    usage = getattr(result["raw"], "usage_metadata", None) or {}
+    record("agent_llm_tokens_total", usage.get("input_tokens", 0), trace_key="llm_input_tokens", direction="input")
+    record("agent_llm_tokens_total", usage.get("output_tokens", 0), trace_key="llm_output_tokens", direction="output")
+    if result["parsing_error"] is not None:
+        raise result["parsing_error"]
+    return result["parsed"]
+
+def _is_repair(state: State):
+    # The assistant is called again after an error step, a new turn starts with the user's message
+    last_message = state["messages"][-1]
+    return isinstance(last_message, AIMessage) and "step" in last_message.response_metadata
+
+def _select_model(state: State):
+    """
+    Returns (structured_model, repair_attempts). The primary model writes the first version of a turn
+    and the last attempt of the repair budget, the repair model handles the iterations in between.
+    """
+    repair_attempts = state.get("repair_attempts", 0) + 1 if _is_repair(state) else 0
+    tier = "repair" if 0 < repair_attempts < REPAIR_BUDGET else "primary"
+    print(f"Assistant model: {tier} (repair attempt {repair_attempts}/{REPAIR_BUDGET})")
+    record("agent_llm_calls_total", 1, trace_key=f"llm_{tier}_calls", tier=tier)
+    model = get_repair_model() if tier == "repair" else get_model()
+    return model.with_structured_output(DiagramData, include_raw=True), repair_attempts
+
+def _check_candidate(output):
+    """Returns output with repaired imports when it passes import and lint checks, otherwise None."""
+    import_code, _, import_issues = repair_imports(output["import_code"])
+    if import_issues or not output["body_code"] or lint_code(import_code, output["body_code"]):
+        return None
+    return {**output, "import_code": import_code}
+
+def _speculative_candidate(structured_model, messages, state, token_counts):
+    output = _assistant_output(_model_response(structured_model.invoke(messages)), state, token_counts)
+    checked = _check_candidate(output)
+    if checked is not None:
+        # The winner is rendered again by create_diagram_image, which then hits the render cache
+        render_result = get_render_pool().render(import_code=checked["import_code"], body_code=checked["body_code"],
+                                                 preview=_render_preview())
+        if render_result.error_message:
+            checked = None
+    return output, checked
+
+def _speculative_result(outputs, winner):
+    record("agent_speculative_candidates_total", len(outputs), result="completed")
+    if winner is not None:
+        print(f"Speculative candidate accepted after {len(outputs)} of {SPECULATIVE_CANDIDATES}")
+        return winner
+    # No candidate rendered: continue with the first one, the repair loop takes it from there
+    print("No speculative candidate rendered")
+    return outputs[0] if outputs else None
+
+def _speculative_assistant(structured_model, messages, state, token_counts):
+    """
+    Generate SPECULATIVE_CANDIDATES responses concurrently, validate and render each one as it
+    arrives, and return the first that renders. Returns None when every candidate failed to parse.
+    """
+    executor = ThreadPoolExecutor(max_workers=SPECULATIVE_CANDIDATES)
+    # Each thread runs in a copy of the context, so streaming and metrics follow the request
+    futures = [executor.submit(contextvars.copy_context().run, _speculative_candidate, structured_model, messages, state, token_counts)
+               for _ in range(SPECULATIVE_CANDIDATES)]
+    outputs = []
+    winner = None
+    try:
+        for future in as_completed(futures):
+            try:
+                output, checked = future.result()
+            except Exception as e:
+                print("Speculative candidate failed:", e)
+                continue
+            outputs.append(output)
+            if checked is not None:
+                winner = checked
+                break
+    finally:
+        # Requests already sent cannot be interrupted, their results are simply ignored
+        executor.shutdown(wait=False, cancel_futures=True)
+    return _speculative_result(outputs, winner)
+
+async def _aspeculative_candidate(structured_model, messages, state, token_counts):
+    output = _assistant_output(_model_response(await structured_model.ainvoke(messages)), state, token_counts)
+    checked = _check_candidate(output)
+    if checked is not None:
+        render_result = await asyncio.wrap_future(get_render_pool().submit(import_code=checked["import_code"],
+                                                                           body_code=checked["body_code"],
+                                                                           preview=_render_preview()))
+        if render_result.error_message:
+            checked = None
+    return output, checked
+
+async def _aspeculative_assistant(structured_model, messages, state, token_counts):
+    tasks = [asyncio.create_task(_aspeculative_candidate(structured_model, messages, state, token_counts))
+             for _ in range(SPECULATIVE_CANDIDATES)]
+    outputs = []
+    winner = None
+    try:
+        for next_candidate in asyncio.as_completed(tasks):
+            try:
+                output, checked = await next_candidate
+            except Exception as e:
+                print("Speculative candidate failed:", e)
+                continue
+            outputs.append(output)
+            if checked is not None:
+                winner = checked
+                break
+    finally:
+        # Cancelling the tasks also aborts their pending LLM requests
+        for task in tasks:
+            task.cancel()
+    return _speculative_result(outputs, winner)
+
+def assistant(state: State):
+    messages, token_counts = _assistant_input(state)
+    print("Assistant context tokens:", token_counts)
+    structured_model, repair_attempts = _select_model(state)
+    if SPECULATIVE_CANDIDATES > 1 and repair_attempts == 0:
+        output = _speculative_assistant(structured_model, messages, state, token_counts)
+        if output is not None:
+            return {**output, "repair_attempts": repair_attempts}
+    response = _model_response(structured_model.invoke(messages))
+    try:
+        output = _assistant_output(response, state, token_counts)
+    except EditError as e:
+        print("Falling back to full regeneration:", e)
+        messages = messages + [SystemMessage(content=FULL_REGENERATION_MESSAGE.format(error=e))]
+        response = _model_response(structured_model.invoke(messages))
+        output = _assistant_output(response, state, token_counts, allow_edits=False)
+    return {**output, "repair_attempts": repair_attempts}
+
+async def aassistant(state: State):
+    messages, token_counts = _assistant_input(state)
+    print("Assistant context tokens:", token_counts)
+    structured_model, repair_attempts = _select_model(state)
+    if SPECULATIVE_CANDIDATES > 1 and repair_attempts == 0:
+        output = await _aspeculative_assistant(structured_model, messages, state, token_counts)
+        if output is not None:
+            return {**output, "repair_attempts": repair_attempts}
+    response = _model_response(await structured_model.ainvoke(messages))
+    try:
+        output = _assistant_output(response, state, token_counts)
+    except EditError as e:
+        print("Falling back to full regeneration:", e)
+        messages = messages + [SystemMessage(content=FULL_REGENERATION_MESSAGE.format(error=e))]
+        response = _model_response(await structured_model.ainvoke(messages))
+        output = _assistant_output(response, state, token_counts, allow_edits=False)
+    return {**output, "repair_attempts": repair_attempts}
+
+def _last_prompt(state: State):
+    return next((message.content for message in reversed(state["messages"]) if isinstance(message, HumanMessage)), "")
+
+def _is_first_turn(state: State):
+    # A thread with no code may still be past its first turn, e.g. after a clarifying question
+    human_messages = [message for message in state["messages"] if isinstance(message, HumanMessage)]
+    return len(human_messages) == 1 and not state.get("import_code") and not state.get("body_code")
+
+def lookup_response_cache(state: State):
+    print("Looking up response cache...")
+    # Only first-turn requests are cached, later turns depend on the conversation before them
+    if not RESPONSE_CACHE or not _is_first_turn(state):
+        return {"cache_prompt": ""}
+    prompt = _last_prompt(state)
+    cached = get_response_cache().get(prompt)
+    record("agent_response_cache_total", 1, result="hit" if cached else "miss")
+    if cached is None:
+        return {"cache_prompt": prompt}
+    ai_message = AIMessage(content=cached["ai_response"],
+                           response_metadata = {
+                                    "cache_hit": True,
+                                    "similarity": cached["similarity"],
+                               })
+    return {"messages": [ai_message],
+            "cache_prompt": "",
+            "import_code": cached["import_code"],
+            "body_code": cached["body_code"],
+            "python_body_code": cached["python_body_code"],
+            "working_import_code": cached["import_code"],
+            "working_body_code": cached["body_code"],
+            "image_path": cached["image_path"],
+            "full_image_path": cached.get("full_image_path")}
+
+async def alookup_response_cache(state: State):
+    # The lookup may call the embeddings API
+    return await asyncio.to_thread(lookup_response_cache, state)
+
+def is_response_cached(state: State):
+    print("Checking for a cached response...")
+    if state["messages"][-1].response_metadata.get("cache_hit"):
+        return True
+    else:
+        return False
+
+def store_response_cache(state: State):
+    print("Storing response in cache...")
+    if state.get("cache_prompt"):
+        ai_response = next((message.content for message in reversed(state["messages"])
+                            if isinstance(message, AIMessage) and "step" not in message.response_metadata), "")
+        get_response_cache().put(state["cache_prompt"], {"import_code": state["import_code"],
+                                                         "body_code": state["body_code"],
+                                                         "ai_response": ai_response,
+                                                         "python_body_code": state["python_body_code"],
+                                                         # Hits are served to every caller, so only the full-quality image is kept
+                                                         "image_path": state.get("full_image_path") or state["image_path"],
+                                                         "full_image_path": state.get("full_image_path") or state["image_path"]})
+    return {"cache_prompt": ""}
+
+async def astore_response_cache(state: State):
+    return await asyncio.to_thread(store_response_cache, state)
+
 def has_body_code_generated(state: State):
     print("Checking if diagram code is generated...")
     if state["import_code"] and state["body_code"]:
@@ -122,14 +437,54 @@ def has_body_code_generated(state: State):
     else:
         return False
 
-def create_diagram_image(state: State):
-    print("Generating diagram...")
-    python_body_code, error_message, image_path = generate(import_code=state["import_code"], 
-                                   body_code=state["body_code"])
+def _render_preview():
+    """Whether the current run renders a preview first, set by the "preview" field of its config (see stream)."""
+    try:
+        return bool(get_config()["configurable"].get("preview", False))
+    except (RuntimeError, KeyError):
+        # Not inside a graph run
+        return False
+
+# Full-quality renders started in the background after a preview, by image path
+_full_renders = {}
+_full_renders_lock = threading.Lock()
+
+def _start_full_render(import_code, body_code):
+    """Render the full-quality image in the background. Returns its code and image path."""
+    python_body_code, full_image_path, _ = build_code(import_code=import_code, body_code=body_code)
+    future = get_render_pool().submit(import_code=import_code, body_code=body_code)
+    if not future.done():
+        with _full_renders_lock:
+            _full_renders[full_image_path] = future
+        def _forget(_):
+            with _full_renders_lock:
+                _full_renders.pop(full_image_path, None)
+        future.add_done_callback(_forget)
+    return python_body_code, full_image_path
+
+def get_full_image(full_image_path, timeout=RENDER_TIMEOUT):
+    """
+    Wait for the background render of full_image_path if it is still running.
+    Returns the path once the image exists, or None when it could not be rendered.
+    """
+    with _full_renders_lock:
+        future = _full_renders.get(full_image_path)
+    if future is not None:
+        try:
+            future.result(timeout=timeout)
+        except Exception as e:
+            print("Full-quality render failed:", e)
+    if full_image_path and os.path.exists(full_image_path):
+        return full_image_path
+    return None
+
+def _diagram_image_output(render_result, state: State):
+    python_body_code, error_message, image_path, error_type = render_result
     if error_message:
         ai_message = AIMessage(content=f"Error generating diagram: **{error_message}** \n. This code generated the error:\n{python_body_code}. Please fix the code.", 
                                response_metadata = {
                                    "step": "create_diagram_image",
+                                   "error_type": error_type,
                                    "error_messages": [error_message],
                                    "python_body_code": python_body_code,               
                                })
@@ -138,18 +493,67 @@ def create_diagram_image(state: State):
                 "python_body_code": python_body_code,
                 "image_path": image_path
             }
+    elif _render_preview():
+        # Show the preview right away, the full-quality image follows in the background
+        python_body_code, full_image_path = _start_full_render(state["import_code"], state["body_code"])
+        return {
+            "python_body_code": python_body_code,
+            "image_path": image_path,
+            "full_image_path": full_image_path,
+            "working_import_code": state["import_code"],
+            "working_body_code": state["body_code"]
+        }
     else:
         return {
             "python_body_code": python_body_code,
-            "image_path": image_path
+            "image_path": image_path,
+            "full_image_path": image_path,
+            "working_import_code": state["import_code"],
+            "working_body_code": state["body_code"]
         }
 
+def create_diagram_image(state: State):
+    print("Generating diagram...")
+    with timed("agent_render_seconds", trace_key="render_seconds"):
+        render_result = get_render_pool().render(import_code=state["import_code"], 
+                                                 body_code=state["body_code"],
+                                                 preview=_render_preview())
+    return _diagram_image_output(render_result, state)
+
+async def acreate_diagram_image(state: State):
+    print("Generating diagram...")
+    # The render runs in a worker process, only the future is awaited here
+    with timed("agent_render_seconds", trace_key="render_seconds"):
+        render_result = await asyncio.wrap_future(get_render_pool().submit(import_code=state["import_code"], 
+                                                                           body_code=state["body_code"],
+                                                                           preview=_render_preview()))
+    return _diagram_image_output(render_result, state)
+
 def validate_imported_modules(state: State):
     print("Validating imported modules...")
-    _, error_messages = check_modules(state["import_code"])
-    return {"error_messages": error_messages}
+    _, error_messages, import_issues = check_modules(state["import_code"])
+    return {"error_messages": error_messages, "import_issues": import_issues}
 
 
+def repair_imported_modules(state: State):
+    print("Repairing imported modules...")
+    import_code, repairs, import_issues = repair_imports(state["import_code"])
+    error_messages = [issue["message"] for issue in import_issues]
+    if not repairs:
+        return {"error_messages": error_messages, "import_issues": import_issues}
+    fixes = "\n".join([f"- {repair['module']}.{repair['name']} -> {repair['new_module']}.{repair['new_name']}" for repair in repairs])
+    ai_message = AIMessage(content=f"Import errors were repaired automatically:\n{fixes}",
+                           response_metadata = {
+                                    "step": "repair_imported_modules",
+                                    "repairs": repairs,
+                                    "error_messages": error_messages,
+                               })
+    return {"messages": [ai_message],
+            "import_code": import_code,
+            "error_messages": error_messages,
+            "import_issues": import_issues
+            }
+
 def is_diagram_image_created(state: State):
     print("Checking if diagram image is created...")
     if state["python_body_code"] and state["image_path"] is not None:
@@ -157,6 +561,67 @@ def is_diagram_image_created(state: State):
     else:
         return False
 
+def lint_body_code(state: State):
+    print("Linting diagram code...")
+    lint_issues = lint_code(state["import_code"], state["body_code"])
+    if not lint_issues:
+        return {"lint_issues": []}
+    error_messages = [f"line {issue['line']}: {issue['message']}" if issue["line"] else issue["message"] for issue in lint_issues]
+    errors = "\n".join([f"- {error}" for error in error_messages])
+    ai_message = AIMessage(content=f"The diagram code has errors and was not rendered:\n{errors}\nPlease fix the code.",
+                           response_metadata = {
+                                    "step": "lint_body_code",
+                                    "error_messages": error_messages,
+                                    "lint_issues": lint_issues,
+                               })
+    return {"messages": [ai_message], "lint_issues": lint_issues}
+
+def has_no_lint_errors(state: State):
+    print("Checking for lint errors...")
+    if len(state["lint_issues"]) > 0:
+        return False
+    else:
+        return True
+
+def has_repair_budget(state: State):
+    print("Checking repair budget...")
+    if state.get("repair_attempts", 0) < REPAIR_BUDGET:
+        return True
+    else:
+        return False
+
+def within_repair_budget(condition):
+    """Router that follows condition, but sends failures to stop_repairs once the repair budget is spent."""
+    def route(state: State):
+        if condition(state):
+            return True
+        return False if has_repair_budget(state) else "stop"
+    route.__name__ = condition.__name__
+    return route
+
+REPAIR_BUDGET_EXHAUSTED_MESSAGE = """I couldn't produce a diagram that renders after {attempts} attempts to fix it. The last errors were:
+{errors}
+Could you rephrase the request, or describe the components you need in more detail?"""
+
+def stop_repairs(state: State):
+    print("Repair budget exhausted...")
+    last_step = next((message for message in reversed(state["messages"])
+                      if isinstance(message, AIMessage) and "step" in message.response_metadata), None)
+    error_messages = last_step.response_metadata.get("error_messages", []) if last_step else state.get("error_messages", [])
+    errors = "\n".join([f"- {error}" for error in error_messages])
+    ai_message = AIMessage(content=REPAIR_BUDGET_EXHAUSTED_MESSAGE.format(attempts=state.get("repair_attempts", 0), errors=errors),
+                           response_metadata = {
+                                    "repair_budget_exhausted": True,
+                                    "error_messages": error_messages,
+                               })
+    # Nothing of the failed turn is returned, and the next turn starts again from the last code that rendered
+    return {"messages": [ai_message],
+            "image_path": None,
+            "full_image_path": None,
+            "python_body_code": "",
+            "import_code": state.get("working_import_code", ""),
+            "body_code": state.get("working_body_code", "")}
+
 def has_no_import_errors(state: State):
     print("Checking for import errors...")
     if len(state["error_messages"]) > 0:
@@ -164,13 +629,7 @@ def has_no_import_errors(state: State):
     else:
         return True
 
-def fetch_documentation_for_errors(state: State):
-    print("Fetching documentation for errors...")
-    error_messages = state["error_messages"]
-    print("Error messages:", error_messages)
-    results = []
-    for error in error_messages:
-        results.append(qdrant_handler.query(error))
+def _documentation_output(error_messages, results):
     ai_message = AIMessage(content=f"Errors of importation encountered:\n{error_messages}\nHere are some relevant documentation snippets that might help:\n{results}",
                            response_metadata = {
                                     "step": "fetch_documentation_for_errors",
@@ -179,18 +638,46 @@ def fetch_documentation_for_errors(state: State):
                                })
     return {"messages": [ai_message]}
 
-model = ChatOpenAI(model=MODEL, api_key=API_KEY, temperature=1)
-embedding = OpenAIEmbeddings(api_key=API_KEY, model=EMBEDDING_MODEL)
-qdrant_handler = QdrantHandler(embedding=embedding)
+def fetch_documentation_for_errors(state: State):
+    print("Fetching documentation for errors...")
+    error_messages = state["error_messages"]
+    print("Error messages:", error_messages)
+    with timed("agent_retrieval_seconds", trace_key="retrieval_seconds"):
+        results = get_retriever().query_batch(error_messages)
+    return _documentation_output(error_messages, results)
+
+async def afetch_documentation_for_errors(state: State):
+    print("Fetching documentation for errors...")
+    error_messages = state["error_messages"]
+    print("Error messages:", error_messages)
+    with timed("agent_retrieval_seconds", trace_key="retrieval_seconds"):
+        results = await get_retriever().aquery_batch(error_messages)
+    return _documentation_output(error_messages, results)
 
 # Build the graph directly
 builder = StateGraph(State)
-builder.add_node("assistant", assistant)
-builder.add_node("validate_imported_modules", validate_imported_modules)
-builder.add_node("fetch_documentation_for_errors", fetch_documentation_for_errors)
-builder.add_node("create_diagram_image", create_diagram_image)
+# Nodes that wait on I/O have an async counterpart, so agent.ainvoke never blocks the event loop
+# Every node records its wall time and status, see metrics_helper
+builder.add_node("lookup_response_cache", RunnableLambda(instrument("lookup_response_cache", lookup_response_cache),
+                                                         afunc=instrument("lookup_response_cache", alookup_response_cache)))
+builder.add_node("store_response_cache", RunnableLambda(instrument("store_response_cache", store_response_cache),
+                                                        afunc=instrument("store_response_cache", astore_response_cache)))
+builder.add_node("assistant", RunnableLambda(instrument("assistant", assistant), afunc=instrument("assistant", aassistant)))
+builder.add_node("validate_imported_modules", instrument("validate_imported_modules", validate_imported_modules))
+builder.add_node("repair_imported_modules", instrument("repair_imported_modules", repair_imported_modules))
+builder.add_node("lint_body_code", instrument("lint_body_code", lint_body_code))
+builder.add_node("stop_repairs", instrument("stop_repairs", stop_repairs))
+builder.add_node("fetch_documentation_for_errors", RunnableLambda(instrument("fetch_documentation_for_errors", fetch_documentation_for_errors),
+                                                                  afunc=instrument("fetch_documentation_for_errors", afetch_documentation_for_errors)))
+builder.add_node("create_diagram_image", RunnableLambda(instrument("create_diagram_image", create_diagram_image),
+                                                        afunc=instrument("create_diagram_image", acreate_diagram_image)))
 
-builder.add_edge(START, "assistant")
+builder.add_edge(START, "lookup_response_cache")
+builder.add_conditional_edges(
+            "lookup_response_cache", 
+            is_response_cached, # a cache hit answers without calling the LLM
+            {True: END, False: "assistant"}
+        )
 builder.add_conditional_edges(
             "assistant", 
             has_body_code_generated, # the function that determines which node to go to next
@@ -199,30 +686,213 @@ builder.add_conditional_edges(
 builder.add_conditional_edges(
             "validate_imported_modules", 
             has_no_import_errors, # the function that determines which node to go to next
-            {True: "create_diagram_image", False: "fetch_documentation_for_errors"} # if the function returns True, go to action, otherwise end the graph
+            {True: "lint_body_code", False: "repair_imported_modules"} # if the function returns True, go to action, otherwise end the graph
+        )
+# Every way back to the assistant is bounded by REPAIR_BUDGET
+builder.add_conditional_edges(
+            "repair_imported_modules", 
+            within_repair_budget(has_no_import_errors), # fall back to the LLM only when some imports could not be repaired
+            {True: "lint_body_code", False: "fetch_documentation_for_errors", "stop": "stop_repairs"}
+        )
+builder.add_conditional_edges(
+            "lint_body_code", 
+            within_repair_budget(has_no_lint_errors), # catch code that would fail before paying for exec and Graphviz
+            {True: "create_diagram_image", False: "assistant", "stop": "stop_repairs"}
         )
 builder.add_edge("fetch_documentation_for_errors", "assistant")
 builder.add_conditional_edges(
             "create_diagram_image", 
-            is_diagram_image_created, # the function that determines which node to go to next
-            {True: END, False: "assistant"} # if the function returns True, go to action, otherwise end the graph
+            within_repair_budget(is_diagram_image_created), # the function that determines which node to go to next
+            {True: "store_response_cache", False: "assistant", "stop": "stop_repairs"} # if the function returns True, go to action, otherwise end the graph
         )
+builder.add_edge("store_response_cache", END)
+builder.add_edge("stop_repairs", END)
+
+# Clients are built on first use and shared by every thread of the process,
+# so importing this module never calls OpenAI or Qdrant
+@singleton
+def get_model():
+    return ChatOpenAI(model=MODEL, api_key=API_KEY, temperature=1,
+                      http_client=get_http_client(),
+                      http_async_client=get_async_http_client())
+
+@singleton
+def get_repair_model():
+    return ChatOpenAI(model=REPAIR_MODEL, api_key=API_KEY, temperature=REPAIR_TEMPERATURE,
+                      http_client=get_http_client(),
+                      http_async_client=get_async_http_client())
+
+@singleton
+def get_embedding():
+    return CachedEmbeddings(OpenAIEmbeddings(api_key=API_KEY, model=EMBEDDING_MODEL,
+                                             http_client=get_http_client(),
+                                             http_async_client=get_async_http_client()))
+
+@singleton
+def get_vector_store():
+    if RETRIEVAL_OFFLINE:
+        return None
+    return QdrantHandler(embedding=get_embedding())
+
+@singleton
+def get_lexical_index():
+    return LexicalIndex.from_folder()
+
+@singleton
+def get_retriever():
+    return DocumentationRetriever(get_lexical_index(), vector_store=get_vector_store())
+
+@singleton
+def get_response_cache():
+    # Without the embeddings API, prompts are compared by hashed character trigrams
+    return ResponseCache(embedding=None if RETRIEVAL_OFFLINE else get_embedding(),
+                         threshold=RESPONSE_CACHE_THRESHOLD,
+                         ttl=RESPONSE_CACHE_TTL,
+                         max_entries=RESPONSE_CACHE_ENTRIES)
+
+@singleton
+def get_render_pool():
+    return RenderPool(max_workers=RENDER_WORKERS,
+                      timeout=RENDER_TIMEOUT,
+                      memory_limit=RENDER_MEMORY_LIMIT_MB * 1024 * 1024,
+                      queue_size=RENDER_QUEUE_SIZE,
+                      cache=RenderCache(max_entries=RENDER_CACHE_ENTRIES))
+
+@singleton
+def get_agent():
+    memory = SQLiteCheckpointer(path=CHECKPOINT_PATH,
+                                ttl=CHECKPOINT_TTL,
+                                max_threads=CHECKPOINT_MAX_THREADS,
+                                max_per_thread=CHECKPOINT_MAX_PER_THREAD)
+    return builder.compile(checkpointer=memory)  # <-- This is now a Graph
 
-memory = MemorySaver()
-agent = builder.compile(checkpointer=memory)  # <-- This is now a Graph
+def __getattr__(name):
+    # `agent.agent.agent` keeps working, but the graph is only compiled when it is first used
+    if name == "agent":
+        return get_agent()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def warm_up(remote=WARM_UP_REMOTE):
+    """
+    Load everything the first request would otherwise pay for: the symbol and lexical indexes,
+    the render workers and the compiled graph. With remote=True, also connect to Qdrant.
+    Failures are printed, never raised, so a missing service cannot break startup.
+    """
+    start = time.perf_counter()
+    steps = [get_symbol_index, get_lexical_index, lambda: get_render_pool().warm_up(), get_agent]
+    if remote:
+        steps += [get_retriever, get_model]
+    for step in steps:
+        try:
+            step()
+        except Exception as e:
+            print("Warm up step failed:", e)
+    print(f"Warm up finished in {time.perf_counter() - start:.2f}s")
+
+def serve_metrics(port=METRICS_PORT):
+    """Start the Prometheus /metrics endpoint when a port is configured. Returns the server or None."""
+    if not port:
+        return None
+    print(f"Serving metrics on port {port}")
+    return start_metrics_server(int(port))
+
+def start_warm_up(remote=WARM_UP_REMOTE):
+    """Run warm_up in a background thread, so it never delays startup."""
+    thread = threading.Thread(target=warm_up, args=(remote,), name="agent-warm-up", daemon=True)
+    thread.start()
+    return thread
 
 # graph_image = agent.get_graph(xray=True).draw_mermaid_png(curve_style=CurveStyle.LINEAR)
 # with open("agent.png", "wb") as f:
 #    f.write(graph_image)
 
-def invoke(message, thread_id="1"):
-    config = {"configurable": {"thread_id": thread_id}}
-    messages = [HumanMessage(content=message)]
-    response = agent.invoke({"messages": messages}, config=config)
+def _unpack_response(response):
     image_path = response.get("image_path", None)
     python_body_code = response.get("python_body_code", None)
     messages = response.get("messages", [])
-    return response["messages"][-1].content, image_path, python_body_code, messages
+    # Internal step messages (repairs, errors, documentation) may come after the assistant's reply
+    reply = next((message for message in reversed(messages)
+                  if isinstance(message, AIMessage) and "step" not in message.response_metadata), messages[-1])
+    return reply.content, image_path, python_body_code, messages
+
+def invoke(message, thread_id="1", callbacks=None):
+    # callbacks (e.g. a RateLimitHandler) are inherited by every model call of the run
+    config = {"configurable": {"thread_id": thread_id}, "callbacks": callbacks}
+    messages = [HumanMessage(content=message)]
+    with trace_request(thread_id=thread_id):
+        response = get_agent().invoke({"messages": messages}, config=config)
+    return _unpack_response(response)
+
+async def ainvoke(message, thread_id="1", callbacks=None):
+    # callbacks (e.g. a RateLimitHandler) are inherited by every model call of the run
+    config = {"configurable": {"thread_id": thread_id}, "callbacks": callbacks}
+    messages = [HumanMessage(content=message)]
+    with trace_request(thread_id=thread_id):
+        response = await get_agent().ainvoke({"messages": messages}, config=config)
+    return _unpack_response(response)
+
+def _partial_ai_response(text):
+    try:
+        data = parse_partial_json(text)
+    except Exception:
+        return None
+    if isinstance(data, dict) and isinstance(data.get("ai_response"), str):
+        return data["ai_response"]
+    return None
+
+def stream(message, thread_id="1", preview=RENDER_PREVIEW):
+    """
+    Run the agent and yield progress events while it works:
+    - {"type": "node", "node": name, "status": "start" | "end"} for every node transition.
+    - {"type": "token", "text": partial_ai_response} while the assistant generates its response.
+    - {"type": "result", "response", "image_path", "full_image_path", "python_body_code", "messages", "metrics"}
+      at the end, with the same values invoke returns, the path the full-quality image is rendered to
+      (see get_full_image) and the RequestTrace summary of the request.
+    With preview=True, image_path is a low resolution preview and the full-quality image is rendered in the background.
+    """
+    config = {"configurable": {"thread_id": thread_id, "preview": preview}}
+    with trace_request(thread_id=thread_id) as trace:
+        yield from _stream(message, config)
+        values = get_agent().get_state(config).values
+        response, image_path, python_body_code, messages = _unpack_response(values)
+        metrics = trace.summary()
+    yield {"type": "result",
+           "response": response,
+           "image_path": image_path,
+           "full_image_path": values.get("full_image_path") if image_path else None,
+           "python_body_code": python_body_code,
+           "messages": messages,
+           "metrics": metrics}
+
+def _stream(message, config):
+    messages = [HumanMessage(content=message)]
+    buffer = ""
+    ai_response = ""
+    message_id = None
+    for mode, chunk in get_agent().stream({"messages": messages}, config=config, stream_mode=["tasks", "messages"]):
+        if mode == "tasks":
+            status = "start" if "input" in chunk else "end"
+            if chunk["name"] == "assistant" and status == "start":
+                buffer = ""
+                ai_response = ""
+                message_id = None
+            yield {"type": "node", "node": chunk["name"], "status": status}
+        elif mode == "messages":
+            message_chunk, metadata = chunk
+            if metadata.get("langgraph_node") != "assistant" or not isinstance(message_chunk, AIMessageChunk):
+                continue
+            # With speculative candidates several responses stream at once, only follow the first
+            message_id = message_id or message_chunk.id
+            if message_chunk.id != message_id:
+                continue
+            # Structured output arrives either as JSON content or as tool call arguments
+            if isinstance(message_chunk.content, str):
+                buffer += message_chunk.content
+            buffer += "".join([tool_call_chunk.get("args") or "" for tool_call_chunk in message_chunk.tool_call_chunks])
+            partial = _partial_ai_response(buffer)
+            if partial and partial != ai_response:
+                ai_response = partial
+                yield {"type": "token", "text": ai_response}
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,180 @@
+"""
+Headless batch generation of diagrams.
+
+Streams prompts from a JSONL file (one {"request_id" | "id", "prompt" | "title" + "body"} object
+per line), runs them through the agent with a pool of workers under client-side limits on
+model requests and tokens, and appends one JSONL result per prompt as soon as it is done. Prompts whose
+id already has a successful result in the output file are skipped, so an interrupted run can
+simply be started again.
+
+Run from the repository root:
+    python -m agent.batch prompts.jsonl results.jsonl --workers 8 --rpm 60 --tpm 200000
+"""
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import agent.agent as agent_module
+    from agent.utils.metrics_helper import trace_request
+    from agent.utils.rate_limiter import RateLimiter, RateLimitHandler
+except ImportError:
+    import agent as agent_module
+    from utils.metrics_helper import trace_request
+    from utils.rate_limiter import RateLimiter, RateLimitHandler
+
+BACKOFF_BASE = 2 # seconds
+BACKOFF_MAX = 60 # seconds
+
+def prompt_id(record, prompt):
+    """The id of a prompt record, or a hash of the prompt when it has none."""
+    return str(record.get("request_id") or record.get("id") or hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16])
+
+def read_prompts(path):
+    """Yield (id, prompt) pairs from a JSONL file, one line at a time."""
+    with open(path, "r") as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Skipping line {line_number}: {e}", file=sys.stderr)
+                continue
+            prompt = record.get("prompt") or "\n\n".join([part for part in (record.get("title"), record.get("body")) if part])
+            if prompt:
+                yield prompt_id(record, prompt), prompt
+
+def completed_ids(path):
+    """Ids that already have a successful result in the output file."""
+    ids = set()
+    try:
+        with open(path, "r") as file:
+            for line in file:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by an interrupted run
+                    continue
+                if result.get("status") == "ok":
+                    ids.add(result["id"])
+    except FileNotFoundError:
+        pass
+    return ids
+
+def backoff(attempt):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def generate_diagram(request_id, prompt, rate_limit_handler, retries):
+    """
+    Run one prompt through the agent, retrying failed attempts. Returns the result record.
+    rate_limit_handler limits every model call of the run, repairs and speculative candidates included.
+    """
+    start = time.perf_counter()
+    error = None
+    for attempt in range(retries + 1):
+        # A new thread per attempt, so a retry never sees the messages of a failed one
+        thread_id = f"batch-{request_id}-{attempt}"
+        with trace_request(request_id=request_id) as trace:
+            try:
+                response, image_path, python_body_code, _ = agent_module.invoke(prompt, thread_id=thread_id, callbacks=[rate_limit_handler])
+                error = None
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            summary = trace.summary()
+        if error is None:
+            break
+        if attempt < retries:
+            delay = backoff(attempt)
+            print(f"{request_id}: attempt {attempt + 1} failed ({error}), retrying in {delay:.1f}s", file=sys.stderr)
+            time.sleep(delay)
+
+    result = {"id": request_id,
+              "prompt": prompt,
+              "status": "error",
+              "error": error,
+              "attempts": attempt + 1,
+              "seconds": round(time.perf_counter() - start, 3),
+              "iterations": summary["loops"],
+              "llm_input_tokens": summary.get("llm_input_tokens", 0),
+              "llm_output_tokens": summary.get("llm_output_tokens", 0),
+              "node_seconds": summary["nodes"]}
+    if error is None:
+        values = agent_module.get_agent().get_state({"configurable": {"thread_id": thread_id}}).values
+        result.update({"status": "ok" if image_path else "no_diagram",
+                       "response": response,
+                       "image_path": image_path,
+                       "import_code": values.get("import_code"),
+                       "body_code": values.get("body_code"),
+                       "python_body_code": python_body_code})
+    return result
+
+def run_batch(input_path, output_path, workers=4, requests_per_minute=None, tokens_per_minute=None, retries=3, limit=None):
+    """
+    Generate a diagram for every prompt of input_path that has no successful result in output_path yet.
+    Results are appended to output_path as they complete. Returns a count of results by status.
+    """
+    done = completed_ids(output_path)
+    rate_limit_handler = RateLimitHandler(RateLimiter(requests_per_minute, tokens_per_minute))
+    # Bound the prompts read ahead of the workers, so large files are streamed
+    pending = threading.BoundedSemaphore(workers * 2)
+    write_lock = threading.Lock()
+    counts = {"skipped": 0}
+    start = time.perf_counter()
+
+    with open(output_path, "a") as output, ThreadPoolExecutor(max_workers=workers) as executor:
+        def _run(request_id, prompt):
+            try:
+                try:
+                    result = generate_diagram(request_id, prompt, rate_limit_handler, retries)
+                except Exception as e:
+                    result = {"id": request_id, "prompt": prompt, "status": "error", "error": f"{type(e).__name__}: {e}"}
+                with write_lock:
+                    output.write(json.dumps(result) + "\n")
+                    output.flush()
+                    counts[result["status"]] = counts.get(result["status"], 0) + 1
+                    finished = sum(counts.values()) - counts["skipped"]
+                    rate = finished / (time.perf_counter() - start) * 3600
+                print(f"[{finished}] {request_id}: {result['status']} in {result.get('seconds', 0)}s ({rate:.0f}/hour)", file=sys.stderr)
+            finally:
+                pending.release()
+
+        submitted = 0
+        for request_id, prompt in read_prompts(input_path):
+            if limit is not None and submitted >= limit:
+                break
+            if request_id in done:
+                counts["skipped"] += 1
+                continue
+            done.add(request_id)
+            pending.acquire()
+            executor.submit(_run, request_id, prompt)
+            submitted += 1
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate diagrams for every prompt of a JSONL file.")
+    parser.add_argument("input", help="JSONL file with a request_id or id and a prompt, or a title and body, per line.")
+    parser.add_argument("output", help="JSONL file the results are appended to. Ids with a successful result are skipped.")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rpm", type=float, help="Maximum model requests per minute, repairs included.")
+    parser.add_argument("--tpm", type=float, help="Maximum model tokens per minute.")
+    parser.add_argument("--retries", type=int, default=3, help="Retries of a failed request, with exponential backoff.")
+    parser.add_argument("--limit", type=int, help="Only generate this many diagrams.")
+    args = parser.parse_args(argv)
+
+    try:
+        counts = run_batch(args.input, args.output, workers=args.workers, requests_per_minute=args.rpm,
+                           tokens_per_minute=args.tpm, retries=args.retries, limit=args.limit)
+    finally:
+        agent_module.get_render_pool().shutdown()
+    print("Done:", ", ".join([f"{count} {status}" for status, count in counts.items()]), file=sys.stderr)
+    return 0 if not counts.get("error") else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+CHECKPOINT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".cache", "checkpoints.sqlite")
+CHECKPOINT_TTL = 7 * 24 * 60 * 60 # seconds a thread is kept after its last use
+CHECKPOINT_MAX_THREADS = 1000 # least recently used threads beyond this are evicted
+CHECKPOINT_MAX_PER_THREAD = 20 # checkpoints kept per thread, older ones are pruned
+EVICTION_INTERVAL = 60 # seconds between TTL and LRU sweeps
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id TEXT PRIMARY KEY,
+    last_access REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL,
+    checkpoint_id TEXT NOT NULL,
+    parent_checkpoint_id TEXT,
+    type TEXT,
+    checkpoint BLOB,
+    metadata_type TEXT,
+    metadata BLOB,
+    channel_versions TEXT,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    version TEXT NOT NULL,
+    type TEXT,
+    value BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL,
+    checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    type TEXT,
+    value BLOB,
+    task_path TEXT,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+CREATE INDEX IF NOT EXISTS threads_last_access ON threads (last_access);
+"""
+
+class SQLiteCheckpointer(BaseCheckpointSaver):
+    """
+    Disk-backed LangGraph checkpointer with bounded growth.
+
+    Only the last max_per_thread checkpoints of each thread are kept, threads unused for
+    ttl seconds are deleted, and once there are more than max_threads threads the least
+    recently used ones are evicted. The database runs in WAL mode, so several server
+    processes can share the same file and therefore the same conversations.
+    Async methods run the sync ones in a worker thread.
+    """
+    def __init__(self, path=CHECKPOINT_PATH, ttl=CHECKPOINT_TTL, max_threads=CHECKPOINT_MAX_THREADS,
+                 max_per_thread=CHECKPOINT_MAX_PER_THREAD, serde=None):
+        super().__init__(serde=serde)
+        self.ttl = ttl
+        self.max_threads = max_threads
+        self.max_per_thread = max(2, max_per_thread)
+        self.lock = threading.Lock()
+        self.last_eviction = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def _touch(self, thread_id):
+        self.connection.execute(
+            "INSERT INTO threads (thread_id, last_access) VALUES (?, ?) "
+            "ON CONFLICT(thread_id) DO UPDATE SET last_access = excluded.last_access",
+            (thread_id, time.time()),
+        )
+
+    def _delete_threads(self, thread_ids):
+        for thread_id in thread_ids:
+            for table in ("checkpoints", "blobs", "writes", "threads"):
+                self.connection.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+
+    def _evict(self):
+        now = time.time()
+        if now - self.last_eviction < EVICTION_INTERVAL:
+            return
+        self.last_eviction = now
+        expired = [row[0] for row in self.connection.execute(
+            "SELECT thread_id FROM threads WHERE last_access < ?", (now - self.ttl,))]
+        overflow = [row[0] for row in self.connection.execute(
+            "SELECT thread_id FROM threads ORDER BY last_access DESC LIMIT -1 OFFSET ?", (self.max_threads,))]
+        self._delete_threads(set(expired) | set(overflow))
+
+    def _prune(self, thread_id, checkpoint_ns):
+        old_ids = [row[0] for row in self.connection.execute(
+            "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+            "ORDER BY checkpoint_id DESC LIMIT -1 OFFSET ?",
+            (thread_id, checkpoint_ns, self.max_per_thread))]
+        if not old_ids:
+            return
+        for checkpoint_id in old_ids:
+            for table in ("checkpoints", "writes"):
+                self.connection.execute(
+                    f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    (thread_id, checkpoint_ns, checkpoint_id))
+        # Drop channel values no remaining checkpoint refers to
+        referenced = set()
+        for (channel_versions,) in self.connection.execute(
+                "SELECT channel_versions FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?",
+                (thread_id, checkpoint_ns)):
+            referenced.update(json.loads(channel_versions).items())
+        for channel, version in self.connection.execute(
+                "SELECT channel, version FROM blobs WHERE thread_id = ? AND checkpoint_ns = ?",
+                (thread_id, checkpoint_ns)).fetchall():
+            if (channel, version) not in referenced:
+                self.connection.execute(
+                    "DELETE FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                    (thread_id, checkpoint_ns, channel, version))
+
+    def _load_tuple(self, row):
+        thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type_, checkpoint, metadata_type, metadata, _ = row
+        checkpoint = self.serde.loads_typed((type_, checkpoint))
+        channel_values = {}
+        for channel, version in checkpoint["channel_versions"].items():
+            blob = self.connection.execute(
+                "SELECT type, value FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                (thread_id, checkpoint_ns, channel, str(version))).fetchone()
+            if blob is not None and blob[0] != "empty":
+                channel_values[channel] = self.serde.loads_typed(blob)
+        writes = self.connection.execute(
+            "SELECT task_id, channel, type, value FROM writes "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_path, task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id)).fetchall()
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}},
+            checkpoint={**checkpoint, "channel_values": channel_values},
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_checkpoint_id}}
+                if parent_checkpoint_id else None
+            ),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((type_, value))) for task_id, channel, type_, value in writes],
+        )
+
+    def get_tuple(self, config):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+        with self.lock:
+            if checkpoint_id:
+                row = self.connection.execute(
+                    "SELECT * FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    (thread_id, checkpoint_ns, checkpoint_id)).fetchone()
+            else:
+                row = self.connection.execute(
+                    "SELECT * FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? ORDER BY checkpoint_id DESC LIMIT 1",
+                    (thread_id, checkpoint_ns)).fetchone()
+            if row is None:
+                return None
+            self._touch(thread_id)
+            self.connection.commit()
+            return self._load_tuple(row)
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        query = "SELECT * FROM checkpoints WHERE 1 = 1"
+        params = []
+        if config:
+            query += " AND thread_id = ?"
+            params.append(config["configurable"]["thread_id"])
+            if config["configurable"].get("checkpoint_ns") is not None:
+                query += " AND checkpoint_ns = ?"
+                params.append(config["configurable"]["checkpoint_ns"])
+            if get_checkpoint_id(config):
+                query += " AND checkpoint_id = ?"
+                params.append(get_checkpoint_id(config))
+        if before and get_checkpoint_id(before):
+            query += " AND checkpoint_id < ?"
+            params.append(get_checkpoint_id(before))
+        query += " ORDER BY checkpoint_id DESC"
+        with self.lock:
+            rows = self.connection.execute(query, params).fetchall()
+        for row in rows:
+            if limit is not None and limit <= 0:
+                break
+            metadata = self.serde.loads_typed((row[6], row[7]))
+            if filter and not all(metadata.get(key) == value for key, value in filter.items()):
+                continue
+            if limit is not None:
+                limit -= 1
+            with self.lock:
+                checkpoint_tuple = self._load_tuple(row)
+            yield checkpoint_tuple
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint = checkpoint.copy()
+        values = checkpoint.pop("channel_values")
+        type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
+        metadata_type, serialized_metadata = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        channel_versions = json.dumps({channel: str(version) for channel, version in checkpoint["channel_versions"].items()})
+        with self.lock:
+            for channel, version in new_versions.items():
+                blob = self.serde.dumps_typed(values[channel]) if channel in values else ("empty", b"")
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO blobs (thread_id, checkpoint_ns, channel, version, type, value) VALUES (?, ?, ?, ?, ?, ?)",
+                    (thread_id, checkpoint_ns, channel, str(version), blob[0], blob[1]))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                 type_, serialized_checkpoint, metadata_type, serialized_metadata, channel_versions))
+            self._touch(thread_id)
+            self._prune(thread_id, checkpoint_ns)
+            self._evict()
+            self.connection.commit()
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        with self.lock:
+            for idx, (channel, value) in enumerate(writes):
+                idx = WRITES_IDX_MAP.get(channel, idx)
+                type_, serialized_value = self.serde.dumps_typed(value)
+                # Regular writes are only recorded once, special ones (errors, interrupts) are replaced
+                verb = "INSERT OR REPLACE" if idx < 0 else "INSERT OR IGNORE"
+                self.connection.execute(
+                    f"{verb} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type_, serialized_value, task_path))
+            self.connection.commit()
+
+    def delete_thread(self, thread_id):
+        with self.lock:
+            self._delete_threads([thread_id])
+            self.connection.commit()
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        tuples = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for checkpoint_tuple in tuples:
+            yield checkpoint_tuple
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id):
+        return await asyncio.to_thread(self.delete_thread, thread_id)
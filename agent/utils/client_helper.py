@@ -0,0 +1,79 @@
+import asyncio
+import weakref
+import functools
+import threading
+import httpx
+
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_KEEPALIVE = 10
+HTTP_KEEPALIVE_EXPIRY = 60
+HTTP_TIMEOUT = 120
+
+def singleton(factory):
+    """
+    Decorator that turns factory into a lazy, thread-safe, process-wide provider:
+    the value is built on the first call and the same instance is returned afterwards.
+    `provider.reset()` drops it, so the next call builds a new one.
+    """
+    lock = threading.Lock()
+    instance = []
+
+    @functools.wraps(factory)
+    def provider():
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+
+    provider.reset = instance.clear
+    provider.is_loaded = lambda: bool(instance)
+    return provider
+
+def _limits():
+    return httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+
+@singleton
+def get_http_client():
+    """Pooled HTTP client shared by every sync OpenAI call in the process. httpx.Client is thread-safe."""
+    return httpx.Client(limits=_limits(), timeout=HTTP_TIMEOUT)
+
+class PerLoopTransport(httpx.AsyncBaseTransport):
+    """
+    Async transport that sends each request through a client of the running event loop. Pooled connections
+    belong to the loop that opened them, so a single pool breaks as soon as that loop is closed, e.g. by a
+    second asyncio.run(). The per-loop clients are plain httpx clients, so proxy settings still apply.
+
+    Attributes:
+        clients (WeakKeyDictionary): Event loop -> its httpx.AsyncClient, dropped with the loop.
+    """
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            client = self.clients.get(loop)
+            if client is None:
+                client = self.clients[loop] = httpx.AsyncClient(**self.kwargs)
+        return client
+
+    async def handle_async_request(self, request):
+        return await self._client().send(request, stream=True)
+
+    async def aclose(self):
+        # Only the client of the running loop can be closed from it
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            client = self.clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+@singleton
+def get_async_http_client():
+    """Pooled HTTP client shared by every async OpenAI call, with a separate pool for each event loop."""
+    return httpx.AsyncClient(transport=PerLoopTransport(limits=_limits(), timeout=HTTP_TIMEOUT), timeout=HTTP_TIMEOUT)
@@ -0,0 +1,52 @@
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately, trim_messages
+
+CONTEXT_TOKEN_BUDGET = 8000
+# Steps whose messages only matter while their repair loop is running
+REPAIR_STEPS = {"repair_imported_modules", "fetch_documentation_for_errors", "lint_body_code", "create_diagram_image"}
+
+def _is_repair_message(message):
+    return isinstance(message, AIMessage) and message.response_metadata.get("step") in REPAIR_STEPS
+
+def compact_history(messages):
+    """
+    Drop repair loop messages from earlier turns. Once the user has sent a new message,
+    the errors and documentation of the previous turn have been resolved one way or another.
+    """
+    last_human = max((i for i, message in enumerate(messages) if isinstance(message, HumanMessage)), default=0)
+    return [message for i, message in enumerate(messages)
+            if i >= last_human or not _is_repair_message(message)]
+
+def build_context(instructions, dynamic_context, messages, max_tokens=CONTEXT_TOKEN_BUDGET):
+    """
+    Assemble the messages sent to the model within a token budget.
+
+    The static instructions always come first, so provider-side prompt caching can reuse them,
+    followed by the compacted history trimmed to the oldest turns that still fit, and the dynamic
+    context (the last working code) last. Returns (messages, token_counts).
+    """
+    instructions_message = SystemMessage(content=instructions)
+    context_message = SystemMessage(content=dynamic_context)
+    fixed_tokens = count_tokens_approximately([instructions_message, context_message])
+
+    history = compact_history(messages)
+    trimmed = trim_messages(history,
+                            max_tokens=max(0, max_tokens - fixed_tokens),
+                            token_counter=count_tokens_approximately,
+                            strategy="last",
+                            start_on="human")
+    if not trimmed and history:
+        # Always keep the latest request, even when it alone exceeds the budget
+        last_human = max((i for i, message in enumerate(history) if isinstance(message, HumanMessage)), default=0)
+        trimmed = history[last_human:]
+
+    history_tokens = count_tokens_approximately(trimmed)
+    token_counts = {
+        "instructions_tokens": count_tokens_approximately([instructions_message]),
+        "context_tokens": count_tokens_approximately([context_message]),
+        "history_tokens": history_tokens,
+        "total_tokens": fixed_tokens + history_tokens,
+        "messages_sent": len(trimmed),
+        "messages_dropped": len(messages) - len(trimmed),
+    }
+    return [instructions_message] + trimmed + [context_message], token_counts
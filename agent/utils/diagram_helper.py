@@ -1,48 +1,96 @@
-import random
-import re
-from datetime import datetime
+import ast
+import json
+import hashlib
+import textwrap
+try:
+    from agent.utils.symbol_index import check_imports
+except ImportError:
+    from utils.symbol_index import check_imports
  
 bgcolors = ["gray89"] # https://graphviz.gitlab.io/doc/info/colors.html
+margin = "-1.5, -2"
+output_folder = "./out"
+IMAGE_KEY_LENGTH = 24 # characters of the render key in image names
+# Resolution of quick preview renders, Graphviz renders PNGs at 96 dpi by default
+preview_dpi = 40
 
 def check_modules(import_code):
-    modules = import_code.split("\n")
-    error_messages = []
-    for module in modules:
-        try:
-            exec(module)
-        except Exception as e:
-            error = str(e)
-            error = re.sub(r"\(.*?\)", "", error).strip()
-            error_messages.append(error)
+    import_issues = check_imports(import_code)
+    error_messages = [issue["message"] for issue in import_issues]
     if len(error_messages) == 0:
         status = True
     else:
         status = False
-    return status, error_messages
+    return status, error_messages, import_issues
 
-def generate(import_code=None, body_code=None):
-    now = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-    filename_value = f"\"./out/diagram_image_{now}\""
+def normalize_code(code, sort_lines=False):
+    """Normalize formatting and comments away, so equivalent code maps to the same render."""
+    code = textwrap.dedent(code or "")
+    try:
+        lines = ast.unparse(ast.parse(code)).split("\n")
+    except SyntaxError:
+        lines = [line.rstrip() for line in code.split("\n") if line.strip()]
+    if sort_lines:
+        lines = sorted(lines)
+    return "\n".join(lines)
+
+def render_key(import_code=None, body_code=None, preview=False):
+    """Content hash of the normalized code and every attribute that affects the rendered image."""
+    attributes = {
+        "import_code": normalize_code(import_code, sort_lines=True),
+        "body_code": normalize_code(body_code),
+        "bgcolors": bgcolors,
+        "margin": margin,
+    }
+    if preview:
+        attributes["dpi"] = preview_dpi
+    content = json.dumps(attributes, sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def image_path_for(key, folder=None):
+    """
+    Path of the image rendered for a render key. Graphviz writes the diagram source next to it,
+    at the same path without the .png extension.
+    """
+    return f"{folder or output_folder}/diagram_image_{key[:IMAGE_KEY_LENGTH]}.png"
+
+def build_code(import_code=None, body_code=None, preview=False):
+    full_key = render_key(import_code=import_code, body_code=body_code)
+    key = render_key(import_code=import_code, body_code=body_code, preview=True) if preview else full_key
+    # The background color is derived from the code, so the same code always renders the same image
+    # and its preview matches it
+    bgcolor = bgcolors[int(full_key, 16) % len(bgcolors)]
+    image_path = image_path_for(key)
+    filename_value = f"\"{image_path[:-len('.png')]}\""
+    dpi = f''',
+    "dpi": "{preview_dpi}"''' if preview else ""
     base_code = f"""
 {import_code}
 graph_attr_value = {{
-    "bgcolor": "{random.choice(bgcolors)}",
-    "margin":"-1.5, -2"
+    "bgcolor": "{bgcolor}",
+    "margin":"{margin}"{dpi}
 }}
 
 filename_value = {filename_value}
 {body_code}
 """
     # {textwrap.indent(body_code, '    ')}
+    return base_code, image_path, key
+
+def run_code(base_code, image_path):
     try:
-        exec(base_code)
+        # A fresh namespace per render, so concurrent renders never share globals
+        exec(base_code, {"__name__": "__diagram__"})
         error_message = None
-        image_path = f"{filename_value.strip('\"')}.png"
     except Exception as e:
         error_message = str(e)
         image_path = None
     return base_code, error_message, image_path
 
+def generate(import_code=None, body_code=None, preview=False):
+    base_code, image_path, _ = build_code(import_code=import_code, body_code=body_code, preview=preview)
+    return run_code(base_code, image_path)
+
 if __name__ == "__main__":
     
     import_code_example = """
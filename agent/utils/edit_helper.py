@@ -0,0 +1,75 @@
+import ast
+import textwrap
+
+class EditError(Exception):
+    """Raised when an edit cannot be applied to the last working code."""
+
+def _indentation(line):
+    return line[:len(line) - len(line.lstrip())]
+
+def _block_indentation(lines):
+    """Indentation of the statements inside the `with Diagram(...)` block."""
+    for line in lines[1:]:
+        if line.strip():
+            return _indentation(line)
+    return "    "
+
+def _reindent(code, indentation):
+    return textwrap.indent(textwrap.dedent(code).strip("\n"), indentation).split("\n")
+
+def _find_lines(lines, search_lines):
+    """Find search_lines in lines ignoring indentation and trailing whitespace. Returns the start index."""
+    stripped = [line.strip() for line in lines]
+    wanted = [line.strip() for line in search_lines if line.strip()]
+    if not wanted:
+        return None
+    matches = [i for i in range(len(stripped) - len(wanted) + 1) if stripped[i:i + len(wanted)] == wanted]
+    if len(matches) != 1:
+        return None
+    return matches[0]
+
+def apply_edit(body_code, search, replace):
+    lines = body_code.rstrip("\n").split("\n")
+    if not search.strip():
+        # Nothing to search for: append to the end of the diagram block
+        return "\n".join(lines + _reindent(replace, _block_indentation(lines)))
+
+    search_lines = search.strip("\n").split("\n")
+    start = _find_lines(lines, search_lines)
+    if start is None:
+        raise EditError(f"Could not find exactly one match for:\n{search}")
+    length = len([line for line in search_lines if line.strip()])
+    # Blank lines inside the matched region were skipped while matching, include them again
+    end = start
+    matched = 0
+    while matched < length:
+        if lines[end].strip():
+            matched += 1
+        end += 1
+    replacement = _reindent(replace, _indentation(lines[start])) if replace.strip() else []
+    return "\n".join(lines[:start] + replacement + lines[end:])
+
+def merge_imports(import_code, new_import_code):
+    lines = [line.strip() for line in (import_code or "").split("\n") if line.strip()]
+    for line in (new_import_code or "").split("\n"):
+        if line.strip() and line.strip() not in lines:
+            lines.append(line.strip())
+    return "\n".join(lines)
+
+def apply_edits(import_code, body_code, new_import_code, edits):
+    """
+    Apply search and replace edits to the last working code.
+
+    Returns (import_code, body_code). Raises EditError when there is no code to edit,
+    an edit does not match exactly one place, or the result is not valid Python.
+    """
+    if not body_code:
+        raise EditError("There is no previous body_code to edit")
+    for edit in edits:
+        body_code = apply_edit(body_code, edit.search, edit.replace)
+    import_code = merge_imports(import_code, new_import_code)
+    try:
+        ast.parse(import_code + "\n" + body_code)
+    except SyntaxError as e:
+        raise EditError(f"The edited code is not valid Python: {e.msg} (line {e.lineno})")
+    return import_code, body_code
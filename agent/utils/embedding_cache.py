@@ -0,0 +1,65 @@
+import os
+import array
+import sqlite3
+import hashlib
+import threading
+from langchain_core.embeddings import Embeddings
+
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".cache", "embeddings.sqlite")
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings model with a persistent on-disk cache keyed by model name and text,
+    so unchanged documents and repeated queries are never embedded twice.
+    """
+    def __init__(self, embedding, path=CACHE_PATH, namespace=None):
+        self.embedding = embedding
+        self.namespace = namespace or getattr(embedding, "model", None) or type(embedding).__name__
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self.connection.commit()
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.namespace}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys):
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array.array("f", blob).tolist()
+        return found
+
+    def _store(self, items):
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, array.array("f", vector).tobytes()) for key, vector in items],
+            )
+            self.connection.commit()
+
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        found = self._lookup(list(set(keys)))
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in found))
+        if missing:
+            vectors = self.embedding.embed_documents(missing)
+            new_items = [(self._key(text), vector) for text, vector in zip(missing, vectors)]
+            self._store(new_items)
+            found.update(new_items)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text):
+        key = self._key(f"query\0{text}")
+        found = self._lookup([key])
+        if key in found:
+            return found[key]
+        vector = self.embedding.embed_query(text)
+        self._store([(key, vector)])
+        return vector
@@ -0,0 +1,111 @@
+import ast
+import difflib
+import textwrap
+try:
+    from agent.utils.symbol_index import get_symbol_index, check_imports
+except ImportError:
+    from utils.symbol_index import get_symbol_index, check_imports
+
+FUZZY_CUTOFF = 0.85
+FUZZY_MARGIN = 0.05
+
+def _provider(module):
+    parts = (module or "").split(".")
+    return ".".join(parts[:2]) if len(parts) >= 2 else None
+
+_provider_names_cache = {}
+
+def _provider_names(index, provider):
+    """Class names defined under a provider (e.g. diagrams.aws) mapped to their modules."""
+    key = (id(index), provider)
+    if key not in _provider_names_cache:
+        names = {}
+        for module, classes in index.classes.items():
+            if module.startswith(provider + "."):
+                for name in classes:
+                    names.setdefault(name, []).append(module)
+        _provider_names_cache[key] = names
+    return _provider_names_cache[key]
+
+def resolve_name(name, hint_module=None, index=None):
+    """
+    Resolve a class name to its canonical module.
+
+    The provider of hint_module (e.g. diagrams.aws for diagrams.aws.network) is preferred,
+    so an icon is never silently swapped for another cloud's icon.
+    Returns (module, name) for a confident match, otherwise None.
+    """
+    index = index or get_symbol_index()
+    provider = _provider(hint_module)
+    if provider is None or provider not in index.modules:
+        # Unknown provider: only a globally unique exact name is confident
+        locations = index.locations.get(name, [])
+        if len(locations) == 1:
+            return locations[0], name
+        return None
+
+    names = _provider_names(index, provider)
+    if name in names:
+        modules = names[name]
+        if hint_module in modules:
+            return hint_module, name
+        return modules[0], name
+
+    lowered = {candidate.lower(): candidate for candidate in names}
+    if name.lower() in lowered:
+        candidate = lowered[name.lower()]
+        return names[candidate][0], candidate
+
+    matches = difflib.get_close_matches(name.lower(), list(lowered), n=2, cutoff=FUZZY_CUTOFF - FUZZY_MARGIN)
+    scored = [(difflib.SequenceMatcher(None, name.lower(), match).ratio(), match) for match in matches]
+    if not scored or scored[0][0] < FUZZY_CUTOFF:
+        return None
+    if len(scored) > 1 and scored[0][0] - scored[1][0] < FUZZY_MARGIN:
+        return None
+    candidate = lowered[scored[0][1]]
+    return names[candidate][0], candidate
+
+def repair_imports(import_code, index=None):
+    """
+    Rewrite unknown imports to their canonical modules using the services catalog.
+
+    Repaired names keep the name used in body_code through an alias, e.g.
+    `from diagrams.aws.network import APIGateway as ApiGateway`.
+    Returns (import_code, repairs, import_issues), where repairs describes each rewrite and
+    import_issues lists the problems that could not be fixed confidently.
+    """
+    index = index or get_symbol_index()
+    import_issues = check_imports(import_code, index=index)
+    if not import_issues or any(issue["kind"] == "syntax" for issue in import_issues):
+        return import_code, [], import_issues
+
+    source = textwrap.dedent(import_code)
+    tree = ast.parse(source)
+    lines = []
+    repairs = []
+    for node in tree.body:
+        if not isinstance(node, ast.ImportFrom) or node.level:
+            lines.append(ast.get_source_segment(source, node))
+            continue
+        module = node.module
+        kept = []
+        moved = {}
+        for alias in node.names:
+            if alias.name == "*" or (index.has_module(module) and index.has_name(module, alias.name)):
+                kept.append(alias)
+                continue
+            resolved = resolve_name(alias.name, hint_module=module, index=index)
+            if resolved is None:
+                kept.append(alias)
+                continue
+            new_module, new_name = resolved
+            local_name = alias.asname or alias.name
+            moved.setdefault(new_module, []).append(ast.alias(name=new_name, asname=local_name if local_name != new_name else None))
+            repairs.append({"module": module, "name": alias.name, "new_module": new_module, "new_name": new_name})
+        if kept:
+            lines.append(ast.unparse(ast.ImportFrom(module=module, names=kept, level=0)))
+        for new_module, names in moved.items():
+            lines.append(ast.unparse(ast.ImportFrom(module=new_module, names=names, level=0)))
+
+    repaired_code = "\n".join(lines)
+    return repaired_code, repairs, check_imports(repaired_code, index=index)
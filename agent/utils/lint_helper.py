@@ -0,0 +1,118 @@
+import ast
+import builtins
+import textwrap
+try:
+    from agent.utils.symbol_index import check_imports
+except ImportError:
+    from utils.symbol_index import check_imports
+
+# Variables defined by build_code before body_code runs
+PREDEFINED_NAMES = {"filename_value", "graph_attr_value"}
+FORBIDDEN_NAMES = {"exec", "eval", "compile", "open", "__import__", "getattr", "setattr", "delattr",
+                   "globals", "locals", "vars", "input", "breakpoint", "exit", "quit", "memoryview"}
+FORBIDDEN_NODES = {
+    ast.Import: "import statements belong in import_code",
+    ast.ImportFrom: "import statements belong in import_code",
+    ast.Global: "global statements are not allowed",
+    ast.Nonlocal: "nonlocal statements are not allowed",
+    ast.FunctionDef: "function definitions are not allowed",
+    ast.AsyncFunctionDef: "function definitions are not allowed",
+    ast.ClassDef: "class definitions are not allowed",
+    ast.Lambda: "lambda expressions are not allowed",
+    ast.While: "while loops are not allowed",
+    ast.Try: "try statements are not allowed",
+    ast.Raise: "raise statements are not allowed",
+    ast.Delete: "del statements are not allowed",
+    ast.Await: "await expressions are not allowed",
+}
+HEADER = 'with Diagram("Diagram name", show=False, filename=filename_value, outformat="png", graph_attr=graph_attr_value):'
+
+def _issue(kind, line, message, name=None):
+    return {"kind": kind, "line": line, "name": name, "message": message}
+
+def _imported_names(import_code):
+    names = set()
+    try:
+        tree = ast.parse(textwrap.dedent(import_code or ""))
+    except SyntaxError:
+        return names
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                names.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, ast.ImportFrom):
+            for alias in node.names:
+                names.add(alias.asname or alias.name)
+    return names
+
+def _keyword(call, name):
+    return next((keyword.value for keyword in call.keywords if keyword.arg == name), None)
+
+def _check_header(tree):
+    if len(tree.body) != 1 or not isinstance(tree.body[0], ast.With):
+        return [_issue("header", 1, f"body_code must be a single block starting with: {HEADER}")]
+    statement = tree.body[0]
+    call = statement.items[0].context_expr
+    if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and call.func.id == "Diagram"):
+        return [_issue("header", statement.lineno, f"body_code must start with: {HEADER}")]
+    issues = []
+    expected = {"filename": "filename_value", "graph_attr": "graph_attr_value"}
+    for keyword, variable in expected.items():
+        value = _keyword(call, keyword)
+        if not (isinstance(value, ast.Name) and value.id == variable):
+            issues.append(_issue("header", statement.lineno, f"Diagram(...) must be called with {keyword}={variable}"))
+    show = _keyword(call, "show")
+    if not (isinstance(show, ast.Constant) and show.value is False):
+        issues.append(_issue("header", statement.lineno, "Diagram(...) must be called with show=False"))
+    outformat = _keyword(call, "outformat")
+    if outformat is not None and not (isinstance(outformat, ast.Constant) and outformat.value == "png"):
+        issues.append(_issue("header", statement.lineno, 'Diagram(...) must be called with outformat="png"'))
+    return issues
+
+def lint_body_code(import_code, body_code):
+    """
+    Statically check body_code before it is executed.
+
+    Checks the required `with Diagram(...)` header, that every referenced name is imported,
+    defined in body_code or a safe builtin, that imported classes exist in the services catalog,
+    that filename_value and graph_attr_value are not redefined, and that no forbidden
+    constructs are used. Returns a list of issues with the keys kind, line, name and message.
+    """
+    try:
+        tree = ast.parse(textwrap.dedent(body_code or ""))
+    except SyntaxError as e:
+        return [_issue("syntax", e.lineno, f"invalid syntax: {e.msg}")]
+
+    issues = _check_header(tree)
+    imported = _imported_names(import_code)
+    bound = set()
+    loaded = []
+    for node in ast.walk(tree):
+        for node_type, message in FORBIDDEN_NODES.items():
+            if isinstance(node, node_type):
+                issues.append(_issue("forbidden", node.lineno, message))
+        if isinstance(node, ast.Attribute) and node.attr.startswith("__"):
+            issues.append(_issue("forbidden", node.lineno, f"access to {node.attr} is not allowed", name=node.attr))
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Store):
+                bound.add(node.id)
+                if node.id in PREDEFINED_NAMES or node.id in imported:
+                    issues.append(_issue("redefined", node.lineno, f"{node.id} must not be redefined", name=node.id))
+            else:
+                loaded.append(node)
+
+    missing = set()
+    for node in loaded:
+        if node.id in FORBIDDEN_NAMES:
+            issues.append(_issue("forbidden", node.lineno, f"{node.id} is not allowed", name=node.id))
+        elif not (node.id in imported or node.id in bound or node.id in PREDEFINED_NAMES
+                  or hasattr(builtins, node.id)) and node.id not in missing:
+            missing.add(node.id)
+            issues.append(_issue("undefined", node.lineno, f"name '{node.id}' is not defined, import it in import_code", name=node.id))
+
+    # Referenced classes must also exist in the catalog
+    used = {node.id for node in loaded}
+    for import_issue in check_imports(import_code):
+        if import_issue["kind"] == "name" and import_issue["name"] in used:
+            issues.append(_issue("unknown_class", None, import_issue["message"], name=import_issue["name"]))
+    return issues
@@ -0,0 +1,240 @@
+import json
+import time
+import uuid
+import inspect
+import functools
+import threading
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13)
+METRIC_HELP = {
+    "agent_node_seconds": "Wall time spent in each graph node.",
+    "agent_node_errors_total": "Graph node runs that raised an exception.",
+    "agent_llm_tokens_total": "Tokens sent to and received from the chat model.",
+    "agent_retrieval_seconds": "Latency of documentation lookups.",
+    "agent_render_seconds": "Latency of diagram renders, including exec and Graphviz.",
+    "agent_request_seconds": "End-to-end latency of a request.",
+    "agent_request_loops": "Extra assistant calls a request needed after the first one.",
+}
+
+def _labels_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join([f'{key}="{value}"' for key, value in items]) + "}"
+
+class MetricsRegistry:
+    """
+    In-process counters and histograms, exported in the Prometheus text format.
+
+    Attributes:
+        counters (dict): (name, labels) -> value.
+        histograms (dict): (name, labels) -> {"buckets", "counts", "sum", "count"}.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, _labels_key(labels))] += value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        with self.lock:
+            histogram = self.histograms.setdefault((name, _labels_key(labels)),
+                                                   {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(histogram["buckets"]):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self):
+        """Plain dict copy of every metric, keyed by name and then by label values."""
+        with self.lock:
+            counters = defaultdict(dict)
+            for (name, labels), value in self.counters.items():
+                counters[name][labels] = value
+            histograms = defaultdict(dict)
+            for (name, labels), histogram in self.histograms.items():
+                histograms[name][labels] = {"sum": histogram["sum"], "count": histogram["count"]}
+        return {"counters": dict(counters), "histograms": dict(histograms)}
+
+    def render(self):
+        """Prometheus text exposition of every metric."""
+        lines = []
+        with self.lock:
+            names = sorted({name for name, _ in self.counters} | {name for name, _ in self.histograms})
+            for name in names:
+                if name in METRIC_HELP:
+                    lines.append(f"# HELP {name} {METRIC_HELP[name]}")
+                counters = [(labels, value) for (key, labels), value in self.counters.items() if key == name]
+                if counters:
+                    lines.append(f"# TYPE {name} counter")
+                    lines += [f"{name}{_format_labels(labels)} {value:g}" for labels, value in counters]
+                    continue
+                lines.append(f"# TYPE {name} histogram")
+                for (key, labels), histogram in self.histograms.items():
+                    if key != name:
+                        continue
+                    for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                        lines.append(f"{name}_bucket{_format_labels(labels, [('le', f'{bound:g}')])} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']:g}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+class RequestTrace:
+    """
+    Metrics of a single request, collected while it runs.
+
+    Attributes:
+        request_id (str): Identifier written to every log line of the request.
+        nodes (list[dict]): One entry per node run, in order, with its name, seconds and status.
+        totals (dict): Summed values such as llm_input_tokens, retrieval_seconds or render_seconds.
+    """
+    def __init__(self, request_id=None):
+        self.request_id = request_id or str(uuid.uuid4())
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.nodes = []
+        self.totals = defaultdict(float)
+
+    def add_node(self, node, seconds, status):
+        with self.lock:
+            self.nodes.append({"node": node, "seconds": round(seconds, 4), "status": status})
+
+    def add(self, key, value):
+        with self.lock:
+            self.totals[key] += value
+
+    def summary(self):
+        with self.lock:
+            nodes = list(self.nodes)
+            totals = {key: round(value, 4) for key, value in self.totals.items()}
+        assistant_calls = len([node for node in nodes if node["node"] == "assistant"])
+        return {"request_id": self.request_id,
+                "seconds": round(time.perf_counter() - self.start, 4),
+                "loops": max(0, assistant_calls - 1),
+                "nodes": nodes,
+                **totals}
+
+REGISTRY = MetricsRegistry()
+_current_trace = contextvars.ContextVar("agent_request_trace", default=None)
+
+def _log(event, **fields):
+    print(json.dumps({"event": event, **fields}, default=str))
+
+def current_trace():
+    return _current_trace.get()
+
+def record(metric, value, trace_key=None, registry=REGISTRY, **labels):
+    """
+    Observe value in the histogram metric and add it to the current request under trace_key.
+    Metrics whose name ends in _total are counters.
+    """
+    if metric.endswith("_total"):
+        registry.inc(metric, value, **labels)
+    else:
+        registry.observe(metric, value, **labels)
+    trace = current_trace()
+    if trace is not None and trace_key:
+        trace.add(trace_key, value)
+
+@contextmanager
+def timed(metric, trace_key=None, **labels):
+    """Record the wall time of the block in the histogram metric."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(metric, time.perf_counter() - start, trace_key=trace_key, **labels)
+
+def _record_node(node, seconds, status, registry):
+    registry.observe("agent_node_seconds", seconds, node=node)
+    if status == "error":
+        registry.inc("agent_node_errors_total", node=node)
+    trace = current_trace()
+    if trace is not None:
+        trace.add_node(node, seconds, status)
+    _log("node", request_id=trace.request_id if trace else None, node=node, seconds=round(seconds, 4), status=status)
+
+def instrument(node, func, registry=REGISTRY):
+    """Wrap a sync or async graph node so every run records its wall time and status."""
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(state):
+            start = time.perf_counter()
+            status = "error"
+            try:
+                result = await func(state)
+                status = "ok"
+                return result
+            finally:
+                _record_node(node, time.perf_counter() - start, status, registry)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(state):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = func(state)
+            status = "ok"
+            return result
+        finally:
+            _record_node(node, time.perf_counter() - start, status, registry)
+    return wrapper
+
+@contextmanager
+def trace_request(request_id=None, registry=REGISTRY, **fields):
+    """
+    Collect the metrics of every node that runs inside the block into a RequestTrace.
+    Inside another trace_request block, the outer trace is reused and nothing is recorded twice.
+    """
+    outer = current_trace()
+    if outer is not None:
+        yield outer
+        return
+    trace = RequestTrace(request_id)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        summary = trace.summary()
+        registry.observe("agent_request_seconds", summary["seconds"])
+        registry.observe("agent_request_loops", summary["loops"], buckets=COUNT_BUCKETS)
+        _log("request", **fields, **{key: value for key, value in summary.items() if key != "nodes"})
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port, host="0.0.0.0", registry=REGISTRY):
+    """Serve registry at http://host:port/metrics from a background thread. Returns the server."""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -1,16 +1,25 @@
 import os
 import json
-from uuid import uuid4
+import asyncio
+import weakref
+import threading
+from uuid import uuid5, NAMESPACE_URL
 import streamlit as st
 from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings
 from langchain_qdrant import QdrantVectorStore
-from qdrant_client import QdrantClient, models
+from qdrant_client import QdrantClient, AsyncQdrantClient, models
 from qdrant_client.http.models import Distance, VectorParams
 
 QDRANT_KEY = st.secrets.get("QDRANT_KEY")
 QDRANT_URL = st.secrets.get("QDRANT_URL")
 COLLECTION_NAME = "diagram_generator"
+BATCH_SIZE = 256
+
+def document_id(document):
+    """Deterministic point ID derived from the document content, so re-ingesting never duplicates points."""
+    content = json.dumps({"page_content": document.page_content, "metadata": document.metadata}, sort_keys=True)
+    return str(uuid5(NAMESPACE_URL, content))
 
 def create_documents(folder):
     documents = []
@@ -46,8 +55,18 @@ def create_documents(folder):
     return documents
 
 class QdrantHandler:
-    def __init__(self, embedding):
-        self.client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_KEY)
+    def __init__(self, embedding, location=None, embedding_size=1536):
+        self.embedding = embedding
+        if location:
+            # e.g. ":memory:" for a local, in-process collection. An async client would open a separate
+            # local store, so async queries run the sync client in a thread instead
+            self.client = QdrantClient(location=location)
+        else:
+            self.client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_KEY)
+        self.location = location
+        # Async clients hold connections of the event loop that opened them, so there is one per loop
+        self.async_clients = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
         try:
             self.vector_store = QdrantVectorStore(
                 client=self.client,
@@ -55,12 +74,23 @@ class QdrantHandler:
                 embedding=embedding,
             )
         except Exception as e:
-            self.create_collection(COLLECTION_NAME, embedding_size=1536)
+            self.create_collection(COLLECTION_NAME, embedding_size=embedding_size)
             self.vector_store = QdrantVectorStore(
                 client=self.client,
                 collection_name=COLLECTION_NAME,
                 embedding=embedding,
             )
+    def async_client(self):
+        """AsyncQdrantClient of the running event loop, None for a local collection."""
+        if self.location:
+            return None
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            client = self.async_clients.get(loop)
+            if client is None:
+                client = self.async_clients[loop] = AsyncQdrantClient(url=QDRANT_URL, api_key=QDRANT_KEY)
+        return client
+
     def create_collection(self, collection_name, embedding_size):
         self.client.create_collection(
             collection_name=collection_name,
@@ -74,9 +104,39 @@ class QdrantHandler:
     def get_collections(self):
         return self.client.get_collections()
 
-    def add_documents(self, documents):
-        uuids = [str(uuid4()) for _ in range(len(documents))]
-        self.vector_store.add_documents(documents=documents, ids=uuids)
+    def add_documents(self, documents, batch_size=BATCH_SIZE):
+        ids = [document_id(document) for document in documents]
+        self.vector_store.add_documents(documents=documents, ids=ids, batch_size=batch_size)
+
+    def get_point_ids(self, batch_size=1000):
+        point_ids = set()
+        offset = None
+        while True:
+            points, offset = self.client.scroll(collection_name=COLLECTION_NAME,
+                                                limit=batch_size,
+                                                offset=offset,
+                                                with_payload=False,
+                                                with_vectors=False)
+            point_ids.update(str(point.id) for point in points)
+            if offset is None:
+                return point_ids
+
+    def sync_documents(self, documents, batch_size=BATCH_SIZE):
+        """
+        Incrementally bring the collection in line with documents: only new or changed
+        documents are embedded and upserted, and points no longer in documents are deleted.
+        """
+        desired = {document_id(document): document for document in documents}
+        existing = self.get_point_ids()
+        to_add = [point_id for point_id in desired if point_id not in existing]
+        to_delete = [point_id for point_id in existing if point_id not in desired]
+        for i in range(0, len(to_add), batch_size):
+            batch = to_add[i:i + batch_size]
+            self.vector_store.add_documents(documents=[desired[point_id] for point_id in batch], ids=batch, batch_size=batch_size)
+        for i in range(0, len(to_delete), batch_size):
+            self.client.delete(collection_name=COLLECTION_NAME,
+                               points_selector=models.PointIdsList(points=to_delete[i:i + batch_size]))
+        return {"added": len(to_add), "deleted": len(to_delete), "unchanged": len(desired) - len(to_add)}
 
     def query(self, query_text, service_name=None, score_min=0, k=3):
         #filter = models.Filter(
@@ -98,19 +158,61 @@ class QdrantHandler:
                 #print(f"* [SIM={score:3f}] {doc.page_content} [{doc.metadata}]")
         return "\n".join(filtered_docs)
 
+    def query_batch(self, query_texts, score_min=0, k=3):
+        """
+        Query several texts with a single embeddings request and a single Qdrant batch search.
+        Results are returned in the same order as query_texts, formatted like query().
+        """
+        if not query_texts:
+            return []
+        vectors = self.embedding.embed_documents(list(query_texts))
+        responses = self.client.query_batch_points(collection_name=COLLECTION_NAME, requests=self._batch_requests(vectors, k))
+        return self._batch_results(responses, score_min)
+
+    async def aquery_batch(self, query_texts, score_min=0, k=3):
+        if not query_texts:
+            return []
+        vectors = await self.embedding.aembed_documents(list(query_texts))
+        requests = self._batch_requests(vectors, k)
+        async_client = self.async_client()
+        if async_client is None:
+            responses = await asyncio.to_thread(self.client.query_batch_points, collection_name=COLLECTION_NAME, requests=requests)
+        else:
+            responses = await async_client.query_batch_points(collection_name=COLLECTION_NAME, requests=requests)
+        return self._batch_results(responses, score_min)
+
+    def _batch_requests(self, vectors, k):
+        return [models.QueryRequest(query=vector,
+                                    using=self.vector_store.vector_name or None,
+                                    limit=k,
+                                    with_payload=True)
+                for vector in vectors]
+
+    def _batch_results(self, responses, score_min):
+        results = []
+        for response in responses:
+            filtered_docs = []
+            for point in response.points:
+                if point.score >= score_min:
+                    filtered_docs.append(point.payload[self.vector_store.metadata_payload_key]["module"])
+            results.append("\n".join(filtered_docs))
+        return results
+
 if __name__ == "__main__":
+    from embedding_cache import CachedEmbeddings
+    from symbol_index import SERVICES_FOLDER
     API_KEY = st.secrets.get("OPENAI_KEY")
     EMBEDDING_MODEL = st.secrets.get("OPENAI_EMBEDDING_MODEL")
     EMBEDDING_SIZE = st.secrets.get("OPENAI_EMBEDDING_SIZE")
 
-    embedding = OpenAIEmbeddings(api_key=API_KEY, model=EMBEDDING_MODEL)
+    embedding = CachedEmbeddings(OpenAIEmbeddings(api_key=API_KEY, model=EMBEDDING_MODEL))
     qdrant_handler = QdrantHandler(embedding=embedding)
     
     ingest = False
     if ingest is True:    
         #qdrant_handler.delete_collection(COLLECTION_NAME)
-        documents = create_documents(folder="D:\\python_scripts\\git_repo\\diagram_generator\\services")
-        qdrant_handler.add_documents(documents[:])
+        documents = create_documents(folder=SERVICES_FOLDER)
+        print(qdrant_handler.sync_documents(documents))
 
     text = "aws api gateway"
     results = qdrant_handler.query(text)
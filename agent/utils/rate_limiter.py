@@ -0,0 +1,107 @@
+import time
+import threading
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages.utils import count_tokens_approximately
+
+# Tokens reserved for the response of a model call, on top of its prompt
+ESTIMATED_OUTPUT_TOKENS = 1000
+
+class RateLimiter:
+    """
+    Client-side limit on requests and tokens per minute, shared by every worker thread.
+
+    Both limits are token buckets refilled continuously. Token usage is usually only known
+    once a request is done, so acquire() takes an estimate and settle() charges the difference;
+    a request that used more than estimated delays the ones after it.
+
+    Attributes:
+        requests_per_minute (float | None): Request limit, None for no limit.
+        tokens_per_minute (float | None): Token limit, None for no limit.
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.lock = threading.Lock()
+        self.request_budget = requests_per_minute or 0
+        self.token_budget = tokens_per_minute or 0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        if self.requests_per_minute:
+            self.request_budget = min(self.requests_per_minute, self.request_budget + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self.token_budget = min(self.tokens_per_minute, self.token_budget + elapsed * self.tokens_per_minute / 60)
+
+    def _wait_time(self, tokens):
+        wait = 0.0
+        if self.requests_per_minute and self.request_budget < 1:
+            wait = max(wait, (1 - self.request_budget) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute:
+            # A request larger than the whole bucket only waits for a full bucket
+            needed = min(tokens, self.tokens_per_minute)
+            if self.token_budget < needed:
+                wait = max(wait, (needed - self.token_budget) * 60 / self.tokens_per_minute)
+        return wait
+
+    def acquire(self, tokens=0):
+        """Block until one request of about tokens tokens fits in both limits, then reserve it."""
+        while True:
+            with self.lock:
+                self._refill()
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    if self.requests_per_minute:
+                        self.request_budget -= 1
+                    if self.tokens_per_minute:
+                        self.token_budget -= tokens
+                    return
+            time.sleep(wait)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Charge the difference between the tokens reserved by acquire() and the tokens actually used."""
+        if not self.tokens_per_minute:
+            return
+        with self.lock:
+            self._refill()
+            self.token_budget -= actual_tokens - estimated_tokens
+
+class RateLimitHandler(BaseCallbackHandler):
+    """
+    Callback handler that applies a RateLimiter to every chat model call of the runs it is passed to,
+    e.g. agent.invoke(..., callbacks=[RateLimitHandler(limiter)]). Each call waits for one request
+    and its estimated tokens before it is sent, and is charged its actual token usage once it ends.
+    In async runs the wait happens in an executor thread, not on the event loop.
+
+    Attributes:
+        rate_limiter (RateLimiter): The limiter shared by every run.
+        reserved (dict): Run id -> tokens reserved for a call in progress.
+    """
+    def __init__(self, rate_limiter, output_tokens=ESTIMATED_OUTPUT_TOKENS):
+        self.rate_limiter = rate_limiter
+        self.output_tokens = output_tokens
+        self.lock = threading.Lock()
+        self.reserved = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        tokens = sum(count_tokens_approximately(prompt) for prompt in messages) + self.output_tokens
+        self.rate_limiter.acquire(tokens)
+        with self.lock:
+            self.reserved[run_id] = tokens
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self.lock:
+            tokens = self.reserved.pop(run_id, None)
+        if tokens is None:
+            return
+        usage = [getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                 for generations in response.generations for generation in generations]
+        if any(usage):
+            self.rate_limiter.settle(tokens, sum(item.get("total_tokens", 0) for item in usage))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        # The reservation is kept: a failed call may still have counted against the provider's limits
+        with self.lock:
+            self.reserved.pop(run_id, None)
@@ -0,0 +1,72 @@
+import os
+import glob
+import threading
+from collections import OrderedDict
+try:
+    from agent.utils.diagram_helper import output_folder, image_path_for, IMAGE_KEY_LENGTH
+except ImportError:
+    from utils.diagram_helper import output_folder, image_path_for, IMAGE_KEY_LENGTH
+
+RENDER_CACHE_ENTRIES = 256
+RENDER_CACHE_BYTES = 256 * 1024 * 1024
+
+class RenderCache:
+    """
+    Least recently used index of rendered images, keyed by render_key.
+
+    Images stay on disk in output_folder; the cache only decides which ones are reused and
+    deletes the least recently used ones once max_entries or max_bytes is exceeded.
+    """
+    def __init__(self, folder=output_folder, max_entries=RENDER_CACHE_ENTRIES, max_bytes=RENDER_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # Pick up images rendered by earlier runs, oldest first. Only paths build_code would have written
+        # are used, not the diagram sources left next to them or other files
+        for path in sorted(glob.glob(os.path.join(folder, "diagram_image_*.png")), key=os.path.getmtime):
+            key = os.path.basename(path)[len("diagram_image_"):-len(".png")]
+            if len(key) == IMAGE_KEY_LENGTH and image_path_for(key, folder) == path:
+                self._add(key, path)
+        with self.lock:
+            self._evict()
+
+    def _add(self, key, path):
+        size = os.path.getsize(path)
+        if key in self.entries:
+            self.total_bytes -= self.entries[key][1]
+        self.entries[key] = (path, size)
+        self.entries.move_to_end(key)
+        self.total_bytes += size
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            _, (path, size) = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, key):
+        """Return the cached image path for a render key, or None."""
+        # Image names use a prefix of the key, see image_path_for
+        key = key[:IMAGE_KEY_LENGTH]
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if not os.path.exists(entry[0]):
+                del self.entries[key]
+                self.total_bytes -= entry[1]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, path):
+        if not path or not os.path.exists(path):
+            return
+        with self.lock:
+            self._add(key[:IMAGE_KEY_LENGTH], path)
+            self._evict()
@@ -0,0 +1,209 @@
+import threading
+import multiprocessing
+from collections import deque
+from typing import NamedTuple, Optional
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+try:
+    from agent.utils.diagram_helper import build_code, run_code
+except ImportError:
+    from utils.diagram_helper import build_code, run_code
+
+RENDER_WORKERS = 2
+RENDER_TIMEOUT = 30 # seconds
+RENDER_MEMORY_LIMIT = 1024 * 1024 * 1024 # bytes of address space per worker
+RENDER_QUEUE_SIZE = 16 # renders running or waiting before new ones are rejected
+# Workers never fork the serving process, with its threads, locks and open connections
+RENDER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+KILL_GRACE = 5 # seconds after the in-worker timeout (or the start of a new worker) before the worker is killed
+
+class RenderResult(NamedTuple):
+    """
+    Outcome of a render job.
+
+    Attributes:
+        python_body_code (str): The full code that was executed.
+        error_message (str | None): The error raised while rendering, if any.
+        image_path (str | None): Path of the rendered image, None on failure.
+        error_type (str | None): One of "render_error", "timeout", "queue_full" or "worker_crashed".
+    """
+    python_body_code: str
+    error_message: Optional[str]
+    image_path: Optional[str]
+    error_type: Optional[str] = None
+
+class RenderTimeout(BaseException):
+    """Raised inside a worker when a render overruns. A BaseException, so the code being rendered cannot swallow it."""
+
+def _init_worker(memory_limit):
+    try:
+        import resource
+        if memory_limit:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    except (ImportError, ValueError, OSError):
+        # resource is not available on Windows
+        pass
+    # Pre-warm the worker so renders do not pay the import cost
+    import diagrams
+
+def _render_job(base_code, image_path, timeout):
+    try:
+        import signal
+        def _on_timeout(signum, frame):
+            raise RenderTimeout(f"Rendering took longer than {timeout} seconds")
+        signal.signal(signal.SIGALRM, _on_timeout)
+        signal.alarm(timeout)
+    except (ImportError, AttributeError, ValueError):
+        # No SIGALRM on Windows, the parent process kills the worker instead
+        signal = None
+    try:
+        python_body_code, error_message, image_path = run_code(base_code, image_path)
+    except RenderTimeout as e:
+        return RenderResult(base_code, str(e), None, "timeout")
+    finally:
+        if signal is not None:
+            signal.alarm(0)
+    return RenderResult(python_body_code, error_message, image_path, "render_error" if error_message else None)
+
+def _warm_up_job():
+    return True
+
+class RenderPool:
+    """
+    Renders diagrams in a pool of pre-warmed worker processes, isolated from the serving process.
+
+    Each job gets a timeout and the workers a memory limit. At most queue_size jobs are
+    accepted at a time, extra jobs are rejected right away with a "queue_full" result.
+    Only max_workers jobs are handed to the processes at once and the rest wait here, so a
+    job's timeout starts when a worker is free to run it, not while it waits in line.
+    When a job overruns its timeout its worker is killed and the pool is recreated;
+    other jobs running in that pool at the time fail with "worker_crashed".
+
+    With a RenderCache, code that was already rendered is answered from the cache without
+    calling Graphviz, and identical renders in flight share a single job.
+    """
+    def __init__(self, max_workers=RENDER_WORKERS, timeout=RENDER_TIMEOUT,
+                 memory_limit=RENDER_MEMORY_LIMIT, queue_size=RENDER_QUEUE_SIZE, cache=None):
+        self.cache = cache
+        self.in_flight = {}
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pending = deque()
+        self.running = 0
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                    mp_context=multiprocessing.get_context(RENDER_START_METHOD),
+                                                    initializer=_init_worker,
+                                                    initargs=(self.memory_limit,))
+            return self.executor
+
+    def _recycle(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _dispatch(self):
+        """Start waiting jobs while there are free workers."""
+        starts = []
+        with self.lock:
+            while self.pending and self.running < self.max_workers:
+                self.running += 1
+                starts.append(self.pending.popleft())
+        for start in starts:
+            start()
+
+    def _finish(self, dispatch=True):
+        with self.lock:
+            self.running -= 1
+        if dispatch:
+            self._dispatch()
+
+    def warm_up(self):
+        executor = self._get_executor()
+        for future in [executor.submit(_warm_up_job) for _ in range(self.max_workers)]:
+            future.result()
+
+    def submit(self, import_code, body_code, preview=False):
+        """Submit a render job, a low resolution one with preview=True. Returns a Future that always resolves to a RenderResult."""
+        base_code, image_path, key = build_code(import_code=import_code, body_code=body_code, preview=preview)
+        result = Future()
+        if self.cache is not None:
+            cached_path = self.cache.get(key)
+            if cached_path is not None:
+                result.set_result(RenderResult(base_code, None, cached_path, None))
+                return result
+        with self.lock:
+            if key in self.in_flight:
+                return self.in_flight[key]
+            self.in_flight[key] = result
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                del self.in_flight[key]
+            result.set_result(RenderResult(base_code, "Too many diagrams are being rendered, try again later", None, "queue_full"))
+            return result
+
+        def _resolve(render_result, dispatch=True):
+            with self.lock:
+                if result.done():
+                    return False
+                self.in_flight.pop(key, None)
+                if self.cache is not None and render_result.image_path:
+                    self.cache.put(key, render_result.image_path)
+                result.set_result(render_result)
+            timer.cancel()
+            self.slots.release()
+            self._finish(dispatch)
+            return True
+
+        def _on_done(job):
+            try:
+                _resolve(job.result())
+            except BrokenProcessPool as e:
+                _resolve(RenderResult(base_code, f"Render worker crashed: {e}", None, "worker_crashed"))
+            except Exception as e:
+                _resolve(RenderResult(base_code, str(e), None, "render_error"))
+
+        def _on_timeout():
+            if _resolve(RenderResult(base_code, f"Rendering took longer than {self.timeout} seconds", None, "timeout"), dispatch=False):
+                # Waiting jobs go to a new pool, not to the one being killed
+                self._recycle(executor)
+                self._dispatch()
+
+        def _start():
+            nonlocal executor
+            try:
+                executor = self._get_executor()
+                job = executor.submit(_render_job, base_code, image_path, self.timeout)
+            except Exception as e:
+                _resolve(RenderResult(base_code, f"Render worker crashed: {e}", None, "worker_crashed"))
+                return
+            # A worker is free, so the job runs right away and the watchdog only times the render
+            timer.start()
+            job.add_done_callback(_on_done)
+
+        executor = None
+        timer = threading.Timer(self.timeout + KILL_GRACE, _on_timeout)
+        timer.daemon = True
+        with self.lock:
+            self.pending.append(_start)
+        self._dispatch()
+        return result
+
+    def render(self, import_code, body_code, preview=False):
+        return self.submit(import_code, body_code, preview=preview).result()
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,108 @@
+import os
+import re
+import time
+import zlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+RESPONSE_CACHE_THRESHOLD = 0.95
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+RESPONSE_CACHE_ENTRIES = 512
+TRIGRAM_DIMENSIONS = 1024
+
+def normalize_prompt(prompt):
+    """Lowercase, drop punctuation and collapse whitespace, so trivially different prompts share a key."""
+    return " ".join(re.sub(r"[^\w\s]", " ", (prompt or "").lower()).split())
+
+class HashedTrigramEmbeddings(Embeddings):
+    """
+    Local stand-in for an embeddings model: character trigram counts hashed into a fixed
+    number of dimensions. Used when the embeddings API is not available.
+    """
+    def __init__(self, dimensions=TRIGRAM_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def embed_query(self, text):
+        vector = [0.0] * self.dimensions
+        padded = f"  {text} "
+        for i in range(len(padded) - 2):
+            vector[zlib.crc32(padded[i:i + 3].encode("utf-8")) % self.dimensions] += 1.0
+        return vector
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+class ResponseCache:
+    """
+    Cache of validated first-turn responses, looked up by normalized prompt and, failing that,
+    by the most similar prompt embedding above threshold. Entries expire after ttl seconds and
+    the least recently used ones are dropped beyond max_entries.
+
+    Attributes:
+        entries (OrderedDict): normalized prompt -> {"vector", "response", "created"}, least recently used first.
+    """
+    def __init__(self, embedding=None, threshold=RESPONSE_CACHE_THRESHOLD, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_ENTRIES):
+        self.embedding = embedding or HashedTrigramEmbeddings()
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def _vector(self, key):
+        vector = np.asarray(self.embedding.embed_query(key), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for key in [key for key, entry in self.entries.items() if entry["created"] < cutoff]:
+            del self.entries[key]
+
+    def _is_valid(self, entry):
+        image_path = entry["response"].get("image_path")
+        # The render cache may have deleted the image since
+        return not image_path or os.path.exists(image_path)
+
+    def _hit(self, key, score):
+        entry = self.entries[key]
+        if not self._is_valid(entry):
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return {**entry["response"], "similarity": score}
+
+    def get(self, prompt):
+        """
+        Return the cached response for prompt, with the similarity it matched with, or None.
+        An exact match of the normalized prompt never calls the embeddings model.
+        """
+        key = normalize_prompt(prompt)
+        with self.lock:
+            self._expire()
+            if key in self.entries:
+                return self._hit(key, 1.0)
+            if not self.entries:
+                return None
+        vector = self._vector(key)
+        with self.lock:
+            keys = list(self.entries)
+            if not keys:
+                return None
+            scores = np.stack([self.entries[entry_key]["vector"] for entry_key in keys]) @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            return self._hit(keys[best], float(scores[best]))
+
+    def put(self, prompt, response):
+        """Store response, a dict with the validated import_code, body_code, ai_response, image_path and python_body_code."""
+        key = normalize_prompt(prompt)
+        vector = self._vector(key)
+        with self.lock:
+            self.entries[key] = {"vector": vector, "response": dict(response), "created": time.time()}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
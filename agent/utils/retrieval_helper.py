@@ -0,0 +1,167 @@
+import re
+import math
+try:
+    from agent.utils.symbol_index import SERVICES_FOLDER
+except ImportError:
+    from utils.symbol_index import SERVICES_FOLDER
+
+# Words that appear in import error messages but say nothing about the class being looked for
+STOPWORDS = {"cannot", "import", "name", "from", "no", "module", "named", "diagrams", "in", "the", "catalog"}
+MIN_SCORE = 0.6
+# Score multiplier for classes outside the provider named in the query
+PROVIDER_PENALTY = 0.6
+
+def _words(text):
+    # Split identifiers on case changes as well, so APIGateway matches "api gateway"
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+    text = re.sub(r"([A-Z]+)([A-Z][a-z])", r"\1 \2", text)
+    return [word for word in re.split(r"[^a-z0-9]+", text.lower()) if word]
+
+def _ngrams(text, n=3):
+    text = f"^{text}$"
+    return [text[i:i + n] for i in range(max(1, len(text) - n + 1))]
+
+class LexicalIndex:
+    """
+    In-process character n-gram index over the documents built by create_documents.
+
+    Class names are matched with TF-IDF weighted trigrams, and provider or section words
+    in the query (aws, network, ...) break ties between classes with similar names.
+    """
+    def __init__(self, documents):
+        self.modules = []
+        self.sections = []
+        seen = set()
+        for document in documents:
+            module = document.metadata["module"]
+            if module in seen:
+                continue
+            seen.add(module)
+            self.modules.append(module)
+            self.sections.append(set(_words(document.metadata["section"])))
+        self.context_words = set().union(*self.sections) if self.sections else set()
+        self.providers = {module.split(".")[1] for module in self.modules}
+
+        document_frequency = {}
+        grams_per_doc = []
+        for module in self.modules:
+            grams = {}
+            for gram in _ngrams(module.split(".")[-1].lower()):
+                grams[gram] = grams.get(gram, 0) + 1
+            grams_per_doc.append(grams)
+            for gram in grams:
+                document_frequency[gram] = document_frequency.get(gram, 0) + 1
+
+        total = len(self.modules)
+        self.idf = {gram: math.log(1 + total / count) for gram, count in document_frequency.items()}
+        self.postings = {}
+        for i, grams in enumerate(grams_per_doc):
+            weights = {gram: count * self.idf[gram] for gram, count in grams.items()}
+            norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+            for gram, weight in weights.items():
+                self.postings.setdefault(gram, []).append((i, weight / norm))
+
+    @classmethod
+    def from_folder(cls, folder=SERVICES_FOLDER):
+        try:
+            from agent.utils.qdrant_helper import create_documents
+        except ImportError:
+            from utils.qdrant_helper import create_documents
+        return cls(create_documents(folder=folder))
+
+    def _parse_query(self, query_text):
+        """Split a query into the class name being looked for and provider or section context words."""
+        quoted = re.findall(r"'([^']+)'", query_text)
+        names = [token for token in quoted if "." not in token]
+        modules = [token for token in quoted if "." in token]
+        if names or modules:
+            context = {word for module in modules for word in _words(module) if word not in STOPWORDS}
+            if not names:
+                # Only a module is known, e.g. No module named 'diagrams.aws.networking'
+                names = [modules[0].split(".")[-1]]
+            return "".join(word for name in names for word in _words(name)), context
+        words = [word for word in _words(query_text) if word not in STOPWORDS]
+        context = {word for word in words if word in self.context_words}
+        name = "".join(word for word in words if word not in self.providers) or "".join(words)
+        return name, context
+
+    def search(self, query_text, k=3):
+        """Return up to k (module, score) pairs, with scores between 0 and 1."""
+        name, context = self._parse_query(query_text)
+        if not name:
+            return []
+
+        query_grams = {}
+        for gram in _ngrams(name):
+            if gram in self.idf:
+                query_grams[gram] = query_grams.get(gram, 0) + self.idf[gram]
+        norm = math.sqrt(sum(weight * weight for weight in query_grams.values())) or 1.0
+        total = sum(query_grams.values()) or 1.0
+
+        # Average the cosine similarity with the share of the query contained in the class name,
+        # so "loadbalancer" still matches ElbClassicLoadBalancer
+        cosine = {}
+        containment = {}
+        for gram, weight in query_grams.items():
+            for i, doc_weight in self.postings[gram]:
+                cosine[i] = cosine.get(i, 0.0) + weight / norm * doc_weight
+                containment[i] = containment.get(i, 0.0) + weight / total
+        scores = {i: 0.5 * cosine[i] + 0.5 * containment[i] for i in cosine}
+
+        providers = context & self.providers
+        sections = context - self.providers
+        for i in scores:
+            if providers and not providers & self.sections[i]:
+                scores[i] *= PROVIDER_PENALTY
+            if sections:
+                scores[i] = 0.9 * scores[i] + 0.1 * len(sections & self.sections[i]) / len(sections)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.modules[i], score) for i, score in ranked]
+
+class DocumentationRetriever:
+    """
+    Looks documentation up in the local lexical index first and falls back to the
+    vector store (a QdrantHandler) only when the lexical match is not confident.
+    Without a vector store, the lexical results are always returned.
+    """
+    def __init__(self, lexical_index, vector_store=None, min_score=MIN_SCORE):
+        self.lexical_index = lexical_index
+        self.vector_store = vector_store
+        self.min_score = min_score
+
+    def _is_confident(self, results):
+        return bool(results) and results[0][1] >= self.min_score
+
+    def query(self, query_text, k=3):
+        results = self.lexical_index.search(query_text, k=k)
+        if self.vector_store is not None and not self._is_confident(results):
+            return self.vector_store.query(query_text, k=k)
+        return "\n".join([module for module, _ in results])
+
+    def _lexical_batch(self, query_texts, k):
+        lexical_results = [self.lexical_index.search(query_text, k=k) for query_text in query_texts]
+        results = ["\n".join([module for module, _ in found]) for found in lexical_results]
+        fallback = []
+        if self.vector_store is not None:
+            fallback = [i for i, found in enumerate(lexical_results) if not self._is_confident(found)]
+        return results, fallback
+
+    def query_batch(self, query_texts, k=3):
+        """
+        Query several texts at once. Queries the lexical index cannot answer confidently are
+        sent to the vector store together in one batch. Results keep the order of query_texts.
+        """
+        results, fallback = self._lexical_batch(query_texts, k)
+        if fallback:
+            vector_results = self.vector_store.query_batch([query_texts[i] for i in fallback], k=k)
+            for i, result in zip(fallback, vector_results):
+                results[i] = result
+        return results
+
+    async def aquery_batch(self, query_texts, k=3):
+        results, fallback = self._lexical_batch(query_texts, k)
+        if fallback:
+            vector_results = await self.vector_store.aquery_batch([query_texts[i] for i in fallback], k=k)
+            for i, result in zip(fallback, vector_results):
+                results[i] = result
+        return results
@@ -0,0 +1,196 @@
+import os
+import ast
+import glob
+import json
+import pickle
+import inspect
+import pkgutil
+import textwrap
+import importlib
+import importlib.metadata
+
+SERVICES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "services")
+SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".cache", "symbol_index.pickle")
+
+PACKAGE = "diagrams"
+
+# Symbols exported by the diagrams package itself, which are not listed in services/*.json
+CORE_SYMBOLS = {
+    "diagrams": ["Diagram", "Cluster", "Edge", "Node", "getdiagram", "setdiagram", "getcluster", "setcluster"],
+    "diagrams.custom": ["Custom"],
+}
+
+class SymbolIndex:
+    """
+    In-memory index of the modules and classes exposed by the diagrams library.
+
+    Attributes:
+        modules (set[str]): Every importable module path, including parent packages.
+        classes (dict[str, set[str]]): Module path to the class names it defines.
+        locations (dict[str, list[str]]): Class name to the module paths that define it.
+        files (dict[str, str]): Module path to the services/*.json catalog file it comes from.
+        package_version (str | None): Version of the installed diagrams package that was indexed.
+    """
+    def __init__(self):
+        self.package_version = None
+        self.modules = set()
+        self.classes = {}
+        self.locations = {}
+        self.files = {}
+
+    def add(self, module, name, file=None, locate=True):
+        parts = module.split(".")
+        for i in range(1, len(parts) + 1):
+            self.modules.add(".".join(parts[:i]))
+        self.classes.setdefault(module, set()).add(name)
+        # Re-exported names can be imported but are not where repairs should point to
+        if locate:
+            locations = self.locations.setdefault(name, [])
+            if module not in locations:
+                locations.append(module)
+        if file is not None:
+            self.files[module] = file
+
+    def has_module(self, module):
+        return module in self.modules
+
+    def has_name(self, module, name):
+        if name in self.classes.get(module, ()):
+            return True
+        # Submodules can be imported from their parent package: from diagrams.aws import compute
+        return f"{module}.{name}" in self.modules
+
+    def file_for(self, module):
+        """Return the catalog file for a module, falling back to its provider's file."""
+        if module in self.files:
+            return self.files[module]
+        parts = module.split(".")
+        if len(parts) < 2:
+            return None
+        provider = ".".join(parts[:2])
+        for known_module, file in self.files.items():
+            if known_module.startswith(provider + "."):
+                return file
+        return None
+
+def package_classes(package=PACKAGE):
+    """
+    Yield (module, class name, defined) for every public class of the installed package's modules, aliases
+    and re-exports included, where defined is False for classes imported from another module.
+    The catalog lags behind new releases of the package, so this is what decides whether an import is valid.
+    """
+    try:
+        root = importlib.import_module(package)
+    except ImportError as e:
+        print(f"Error importing {package}, only the services catalog is indexed: {e}")
+        return
+    for module_info in pkgutil.walk_packages(root.__path__, prefix=f"{package}."):
+        try:
+            module = importlib.import_module(module_info.name)
+        except Exception as e:
+            print(f"Error importing {module_info.name}: {e}")
+            continue
+        for name, value in vars(module).items():
+            if not name.startswith("_") and inspect.isclass(value):
+                yield module.__name__, name, value.__module__ == module.__name__
+
+def package_version(package=PACKAGE):
+    try:
+        return importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+def build_symbol_index(folder=SERVICES_FOLDER):
+    index = SymbolIndex()
+    index.package_version = package_version()
+    for module, names in CORE_SYMBOLS.items():
+        for name in names:
+            index.add(module, name)
+    # Catalog entries come first, so repairs prefer the modules the catalog and documentation know about
+    for filepath in sorted(glob.glob(os.path.join(folder, "*.json"))):
+        file = os.path.basename(filepath)
+        with open(filepath, "r") as f:
+            data = json.load(f)
+        for section, paths in data.items():
+            for path in paths:
+                module, name = path.rsplit(".", 1)
+                index.add(module, name, file=file)
+    for module, name, defined in package_classes():
+        index.add(module, name, locate=defined)
+    return index
+
+def load_symbol_index(folder=SERVICES_FOLDER, snapshot_path=SNAPSHOT_PATH):
+    """
+    Load the symbol index from a pickled snapshot, rebuilding it when any
+    services/*.json file is newer than the snapshot or another version of diagrams is installed.
+    """
+    catalog_mtime = max((os.path.getmtime(p) for p in glob.glob(os.path.join(folder, "*.json"))), default=0)
+    if snapshot_path and os.path.exists(snapshot_path) and os.path.getmtime(snapshot_path) >= catalog_mtime:
+        try:
+            with open(snapshot_path, "rb") as f:
+                index = SymbolIndex()
+                # Plain containers are pickled so the snapshot does not depend on the import path of this module
+                index.__dict__.update(pickle.load(f))
+            if index.package_version == package_version():
+                return index
+        except Exception as e:
+            print(f"Error reading symbol index snapshot {snapshot_path}: {e}")
+    index = build_symbol_index(folder)
+    if snapshot_path:
+        try:
+            os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+            with open(snapshot_path, "wb") as f:
+                pickle.dump(index.__dict__, f)
+        except OSError as e:
+            print(f"Error writing symbol index snapshot {snapshot_path}: {e}")
+    return index
+
+_symbol_index = None
+
+def get_symbol_index():
+    global _symbol_index
+    if _symbol_index is None:
+        _symbol_index = load_symbol_index()
+    return _symbol_index
+
+def _issue(kind, line, message, module=None, name=None, file=None):
+    return {"kind": kind, "module": module, "name": name, "file": file, "line": line, "message": message}
+
+def _missing_module_message(module):
+    if module == "diagrams" or module.startswith("diagrams."):
+        return f"No module named '{module}'"
+    return f"No module named '{module}' in the diagrams catalog"
+
+def check_imports(import_code, index=None):
+    """
+    Statically check import statements against the symbol index without executing them.
+
+    Returns a list of issues, one dict per problem, with the keys
+    kind ("syntax", "statement", "module" or "name"), module, name, file, line and message.
+    """
+    index = index or get_symbol_index()
+    try:
+        tree = ast.parse(textwrap.dedent(import_code or ""))
+    except SyntaxError as e:
+        return [_issue("syntax", e.lineno, f"invalid syntax: {e.msg}")]
+
+    issues = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if not index.has_module(alias.name):
+                    issues.append(_issue("module", node.lineno, _missing_module_message(alias.name),
+                                         module=alias.name, file=index.file_for(alias.name)))
+        elif isinstance(node, ast.ImportFrom):
+            module = node.module or ""
+            if node.level or not index.has_module(module):
+                issues.append(_issue("module", node.lineno, _missing_module_message(module),
+                                     module=module, file=index.file_for(module)))
+                continue
+            for alias in node.names:
+                if alias.name != "*" and not index.has_name(module, alias.name):
+                    issues.append(_issue("name", node.lineno, f"cannot import name '{alias.name}' from '{module}'",
+                                         module=module, name=alias.name, file=index.file_for(module)))
+        else:
+            issues.append(_issue("statement", node.lineno, f"only import statements are allowed, got: {ast.unparse(node)}"))
+    return issues
@@ -1,17 +1,110 @@
+import os
+import functools
 import uuid
 import time
 import re
 import streamlit as st
 from datetime import datetime
 from agent.utils.diagram_helper import generate
-from agent.agent import invoke 
+from agent.agent import stream, start_warm_up, serve_metrics, get_full_image
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 
 
-def display_past_values(image_path, python_diagram_code):
+# Chat messages shown in the sidebar at first, earlier ones are loaded on demand
+HISTORY_PAGE_SIZE = 20
+
+NODE_LABELS = {
+    "lookup_response_cache": "Looking up similar requests...",
+    "store_response_cache": "Saving response...",
+    "assistant": "Generating diagram code...",
+    "validate_imported_modules": "Validating imported modules...",
+    "repair_imported_modules": "Repairing imported modules...",
+    "fetch_documentation_for_errors": "Fetching documentation for errors...",
+    "lint_body_code": "Checking diagram code...",
+    "create_diagram_image": "Rendering diagram...",
+    "stop_repairs": "Giving up on repairs...",
+}
+
+@st.cache_resource
+def warm_up_agent():
+    # Runs once per server process, in the background, so the first page load never waits on it
+    serve_metrics()
+    return start_warm_up()
+
+def display_past_values(image_path, python_diagram_code, full_image_path=None):
     st.session_state.image_path = image_path
+    st.session_state.full_image_path = full_image_path
     st.session_state.python_diagram_code = python_diagram_code
 
+@st.cache_data(max_entries=32, show_spinner=False)
+def _load_image(image_path, mtime):
+    with open(image_path, "rb") as img_file:
+        return img_file.read()
+
+def load_image(image_path):
+    """Image bytes, kept in memory until the file changes."""
+    return _load_image(image_path, os.path.getmtime(image_path))
+
+def read_full_image(full_image_path, image_path):
+    # Called on a separate thread when the download button is clicked, waits for the background render if needed
+    with open(get_full_image(full_image_path) or image_path, "rb") as img_file:
+        return img_file.read()
+
+def show_earlier_messages():
+    st.session_state.history_limit += HISTORY_PAGE_SIZE
+
+def format_message(message):
+    message_type = type(message)
+    if message_type == HumanMessage:
+        message_type = "Human"
+        message_content = message.content if hasattr(message, 'content') else str(message)
+    elif message_type == AIMessage:
+        message_type = "AI"
+        response_metadata = message.response_metadata if hasattr(message, 'response_metadata') else  None
+        # Only workflow steps are shown by their details, replies carry other metadata such as token counts
+        if response_metadata and "step" in response_metadata:
+            message_content = ""
+            if "step" in response_metadata:
+                message_content += f"\n\n     Step: {response_metadata['step']}"
+            if "error_messages" in response_metadata:
+                error_msgs = response_metadata["error_messages"]
+                if isinstance(error_msgs, list):
+                    error_msgs = "\n".join([f"- {err}" for err in error_msgs])
+                message_content += f"\n\n     Error Messages:\n{error_msgs}"
+            if "documentation_snippets" in response_metadata:
+                doc_snippets = response_metadata["documentation_snippets"]
+                if isinstance(doc_snippets, list):
+                    doc_snippets = "\n".join([f"- {snippet}" for snippet in doc_snippets])
+                message_content += f"\n\n     Documentation Snippets:\n{doc_snippets}"
+            if "python_diagram_code" in response_metadata:
+                python_code = response_metadata["python_diagram_code"]
+                if python_code:
+                    message_content += f"\n\n     Python Diagram Code:\n```python\n{python_code}\n```"
+        else:
+            message_content = message.content if hasattr(message, 'content') else str(message)
+    else:
+        message_type = "System"
+        message_content = message.content if hasattr(message, 'content') else str(message)
+    return f"**{message_type}:** {message_content}"
+
+def formatted_reasoning(messages):
+    """
+    Markdown of the agent messages. Each message is formatted once and kept by id, so a new turn
+    only formats the messages it added.
+    """
+    cache = st.session_state.formatted_messages
+    formatted_messages = []
+    for message in messages:
+        if message.id is None:
+            formatted_messages.append(format_message(message))
+            continue
+        if message.id not in cache:
+            cache[message.id] = format_message(message)
+        formatted_messages.append(cache[message.id])
+    return "\n\n".join(formatted_messages)
+
+
+warm_up_agent()
 
 if "chat_id" not in st.session_state:
     st.session_state.chat_id = str(uuid.uuid4())
@@ -22,12 +115,24 @@ if "messages" not in st.session_state:
 if "image_path" not in st.session_state:
     st.session_state.image_path = None
 
+if "full_image_path" not in st.session_state:
+    st.session_state.full_image_path = None
+
 if "python_diagram_code" not in st.session_state:
     st.session_state.python_diagram_code = ""
 
 if "state_messages" not in st.session_state:
     st.session_state.state_messages = []
 
+if "request_metrics" not in st.session_state:
+    st.session_state.request_metrics = None
+
+if "formatted_messages" not in st.session_state:
+    st.session_state.formatted_messages = {}
+
+if "history_limit" not in st.session_state:
+    st.session_state.history_limit = HISTORY_PAGE_SIZE
+
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = ["Chat 1","Chat 2","Chat 3"]
 
@@ -40,28 +145,56 @@ with st.sidebar:
 
     
     # Display chat messages from history on app rerun
-    with st.container(height=400):
-        for message in st.session_state.messages:
+    history = st.container(height=400)
+    with history:
+        # Only the latest page of messages is rendered, long chats stay fast to rerun
+        first = max(0, len(st.session_state.messages) - st.session_state.history_limit)
+        if first > 0:
+            st.button(f"Show earlier messages ({first})", key="show_earlier_messages", on_click=show_earlier_messages)
+        for i, message in enumerate(st.session_state.messages[first:], start=first):
             with st.chat_message(name=message["role"]):
                 st.markdown(message["content"])
                 if message["role"] == "assistant":
                     if message["metadata"].get("image_path") and message["metadata"].get("python_diagram_code"):
-                        key = str(uuid.uuid4())
+                        # Messages are only ever appended, so the index is a stable key
+                        key = f"diagram_button_{i}"
                         st.button(f"Generated Diagram 🖼️", 
                                 type="primary",
                                 key=key,
                                 on_click=display_past_values,
-                                args=(message["metadata"].get("image_path"), message["metadata"].get("python_diagram_code"))
+                                args=(message["metadata"].get("image_path"), message["metadata"].get("python_diagram_code"),
+                                      message["metadata"].get("full_image_path"))
                                 )
 
     message = st.chat_input("What is up?")
     if message:
-        response, image_path, python_diagram_code, messages = invoke(message=message, thread_id=st.session_state.chat_id)
+        # Show progress and the partial response while the agent works
+        with history:
+            with st.chat_message(name="user"):
+                st.markdown(message)
+            with st.chat_message(name="assistant"):
+                status = st.status("Thinking...")
+                placeholder = st.empty()
+                for event in stream(message=message, thread_id=st.session_state.chat_id):
+                    if event["type"] == "node" and event["status"] == "start":
+                        status.update(label=NODE_LABELS.get(event["node"], event["node"]))
+                        status.write(NODE_LABELS.get(event["node"], event["node"]))
+                    elif event["type"] == "token":
+                        placeholder.markdown(event["text"])
+                    elif event["type"] == "result":
+                        result = event
+                status.update(label="Done", state="complete")
+        response = result["response"]
+        image_path = result["image_path"]
+        python_diagram_code = result["python_body_code"]
+        messages = result["messages"]
         st.session_state.state_messages = messages
+        st.session_state.request_metrics = result["metrics"]
         
         metadata = {}
         if image_path != st.session_state.image_path:
             metadata["image_path"] = image_path
+            metadata["full_image_path"] = result["full_image_path"]
         else:
             metadata["image_path"] = None
         if python_diagram_code != st.session_state.python_diagram_code:
@@ -72,6 +205,7 @@ with st.sidebar:
         st.session_state.messages.append({"role": "user", "content": message})
         st.session_state.messages.append({"role": "assistant", "content": response, "metadata": metadata})
         st.session_state.image_path = image_path
+        st.session_state.full_image_path = result["full_image_path"]
         st.session_state.python_diagram_code = python_diagram_code
         st.rerun()
 
@@ -80,17 +214,23 @@ tab1, tab2, tab3, tab4 = st.tabs(["Diagram", "Python Diagram Code", "Agent Graph
 
 with tab1:
     try:
-        st.image(st.session_state.image_path)
+        # Show the full-quality image once its background render is done, the preview until then
+        full_image_path = st.session_state.full_image_path
+        if full_image_path and os.path.exists(full_image_path):
+            st.image(load_image(full_image_path))
+        else:
+            st.image(load_image(st.session_state.image_path))
+            if full_image_path:
+                st.caption("Preview, the full-quality image is still rendering.")
         # Add download button for the diagram image
         if st.session_state.image_path:
-            with open(st.session_state.image_path, "rb") as img_file:
-                with st.container(horizontal=True, horizontal_alignment="right"):
-                    st.download_button(
-                        label="Download Diagram Image",
-                        data=img_file,
-                        file_name="diagram.png",
-                        mime="image/png"
-                    )
+            with st.container(horizontal=True, horizontal_alignment="right"):
+                st.download_button(
+                    label="Download Diagram Image",
+                    data=functools.partial(read_full_image, full_image_path, st.session_state.image_path),
+                    file_name="diagram.png",
+                    mime="image/png"
+                )
     except:
         pass
 
@@ -98,41 +238,17 @@ with tab2:
     st.code(st.session_state.python_diagram_code)
 
 with tab3:
-    st.image("static/agent_graph.png", caption="Agent")
+    st.image(load_image("static/agent_graph.png"), caption="Agent")
 
 with tab4:
-    formatted_messages = []
-    for message in st.session_state.state_messages:        
-        message_type = type(message)
-        if message_type == HumanMessage:
-            message_type = "Human"
-            message_content = message.content if hasattr(message, 'content') else str(message)
-        elif message_type == AIMessage:
-            message_type = "AI"
-            response_metadata = message.response_metadata if hasattr(message, 'response_metadata') else  None
-            if response_metadata:
-                message_content = ""
-                if "step" in response_metadata:
-                    message_content += f"\n\n     Step: {response_metadata['step']}"
-                if "error_messages" in response_metadata:
-                    error_msgs = response_metadata["error_messages"]
-                    if isinstance(error_msgs, list):
-                        error_msgs = "\n".join([f"- {err}" for err in error_msgs])
-                    message_content += f"\n\n     Error Messages:\n{error_msgs}"
-                if "documentation_snippets" in response_metadata:
-                    doc_snippets = response_metadata["documentation_snippets"]
-                    if isinstance(doc_snippets, list):
-                        doc_snippets = "\n".join([f"- {snippet}" for snippet in doc_snippets])
-                    message_content += f"\n\n     Documentation Snippets:\n{doc_snippets}"
-                if "python_diagram_code" in response_metadata:
-                    python_code = response_metadata["python_diagram_code"]
-                    if python_code:
-                        message_content += f"\n\n     Python Diagram Code:\n```python\n{python_code}\n```"
-            else:
-                message_content = message.content if hasattr(message, 'content') else str(message)
-        elif message_type == SystemMessage:
-            message_type = "System"
-        
-        formatted_message = f"**{message_type}:** {message_content}"
-        formatted_messages.append(formatted_message)
-    st.markdown("\n\n".join(formatted_messages))
\ No newline at end of file
+    request_metrics = st.session_state.request_metrics
+    if request_metrics:
+        with st.container(horizontal=True):
+            st.metric("Total time", f"{request_metrics['seconds']:.2f} s")
+            st.metric("Repair loops", request_metrics["loops"])
+            st.metric("LLM tokens (in / out)", f"{request_metrics.get('llm_input_tokens', 0):.0f} / {request_metrics.get('llm_output_tokens', 0):.0f}")
+            st.metric("Retrieval", f"{request_metrics.get('retrieval_seconds', 0):.2f} s")
+            st.metric("Render", f"{request_metrics.get('render_seconds', 0):.2f} s")
+        st.dataframe(request_metrics["nodes"], width="stretch")
+
+    st.markdown(formatted_reasoning(st.session_state.state_messages))
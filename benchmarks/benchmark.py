@@ -0,0 +1,365 @@
+"""
+Offline benchmark of the diagram agent.
+
+Replays prompts from a JSONL corpus through `invoke()` with a deterministic fake chat model
+and, optionally, an in-memory Qdrant collection, so no OpenAI or Qdrant access is needed.
+Reports end-to-end latency, a per-node breakdown, repair iterations, renders per second and
+peak RSS, plus component timings for check_modules, lint, retrieval and generate.
+
+Run from the repository root:
+    python -m benchmarks.benchmark --prompts requests.jsonl --output results.json
+    python -m benchmarks.benchmark --baseline results.json   # exits with 1 on a regression
+"""
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import resource
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.runnables import RunnableLambda
+
+import agent.agent as agent_module
+from agent.utils.client_helper import singleton
+from agent.utils.diagram_helper import check_modules, generate
+from agent.utils.lint_helper import lint_body_code
+from agent.utils.metrics_helper import trace_request
+from agent.utils.qdrant_helper import QdrantHandler, create_documents
+from agent.utils.render_pool import RenderPool
+from agent.utils.symbol_index import SERVICES_FOLDER, get_symbol_index
+
+SCENARIOS = ("clean", "repair", "docs", "lint")
+FAKE_EMBEDDING_SIZE = 64
+# Lower is better for every gated metric except those listed here
+HIGHER_IS_BETTER = {"render_pool_renders_per_second"}
+
+def load_prompts(path, limit=None):
+    """Prompts from a JSONL file, taken from the prompt, title or body field of each line."""
+    prompts = []
+    with open(path, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            prompt = record.get("prompt") or record.get("title") or record.get("body")
+            if prompt:
+                prompts.append(prompt)
+    return prompts[:limit] if limit else prompts
+
+def _seed(prompt):
+    return int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16], 16)
+
+def _clean_response(prompt, rng):
+    index = get_symbol_index()
+    modules = sorted(module for module in index.classes if module.startswith("diagrams.aws.") and index.classes[module])
+    picks = []
+    for module in rng.sample(modules, 3):
+        picks.append((module, rng.choice(sorted(index.classes[module]))))
+    import_code = "\n".join(["from diagrams import Diagram"] + [f"from {module} import {name}" for module, name in picks])
+    title = prompt[:40].replace('"', "'").replace("\\", "")
+    nodes = " >> ".join([f'{name}("{name.lower()}{i}")' for i, (_, name) in enumerate(picks)])
+    body_code = (f'with Diagram("{title}", show=False, filename=filename_value, outformat="png", graph_attr=graph_attr_value):\n'
+                 f"    {nodes}")
+    return {"import_code": import_code, "body_code": body_code, "ai_response": f"Here is the diagram for: {title}"}
+
+def scripted_responses(prompt, scenario):
+    """
+    Deterministic DiagramData responses for prompt. The first one exercises scenario,
+    the last one is always valid:
+    - clean: valid code on the first try.
+    - repair: a misspelled class name that the import repair step fixes locally.
+    - docs: an unknown class that needs a documentation lookup and a second LLM call.
+    - lint: a wrong Diagram header that the lint step sends back to the assistant.
+    """
+    rng = random.Random(_seed(prompt))
+    clean = _clean_response(prompt, rng)
+    if scenario == "repair":
+        name = clean["import_code"].split(" import ")[-1]
+        typo = name + name[-1]
+        return [dict(clean, import_code=clean["import_code"].replace(f"import {name}", f"import {typo}"),
+                     body_code=clean["body_code"].replace(f"{name}(", f"{typo}("))]
+    if scenario == "docs":
+        broken = dict(clean, import_code=clean["import_code"] + "\nfrom diagrams.aws.compute import QuantumMainframe")
+        return [broken, clean]
+    if scenario == "lint":
+        return [dict(clean, body_code=clean["body_code"].replace("show=False", "show=True")), clean]
+    return [clean]
+
+class FakeDiagramModel:
+    """
+    Deterministic stand-in for the chat model. Plays back the responses scripted (or recorded)
+    for the last user prompt, one per assistant call, and reports approximate token usage.
+
+    Attributes:
+        responses (dict): prompt -> list of DiagramData dicts.
+        scenario_for (callable): prompt -> scenario, used for prompts without recorded responses.
+        latency (float): Seconds to sleep per call, to simulate the API.
+    """
+    def __init__(self, responses=None, scenario_for=None, latency=0.0):
+        self.responses = responses or {}
+        self.scenario_for = scenario_for or (lambda prompt: "clean")
+        self.latency = latency
+
+    def _respond(self, messages):
+        last_human = max(i for i, message in enumerate(messages) if isinstance(message, HumanMessage))
+        prompt = messages[last_human].content
+        attempt = len([message for message in messages[last_human:]
+                       if isinstance(message, AIMessage) and "step" not in message.response_metadata])
+        responses = self.responses.get(prompt) or scripted_responses(prompt, self.scenario_for(prompt))
+        data = responses[min(attempt, len(responses) - 1)]
+        if self.latency:
+            time.sleep(self.latency)
+        content = json.dumps(data)
+        usage = {"input_tokens": count_tokens_approximately(messages),
+                 "output_tokens": len(content) // 4,
+                 "total_tokens": count_tokens_approximately(messages) + len(content) // 4}
+        return AIMessage(content=content, usage_metadata=usage), data
+
+    def with_structured_output(self, schema, include_raw=False, **kwargs):
+        def invoke(messages):
+            raw, data = self._respond(messages)
+            parsed = schema(**data)
+            return {"raw": raw, "parsed": parsed, "parsing_error": None} if include_raw else parsed
+        return RunnableLambda(invoke)
+
+def load_recorded_responses(path):
+    """Recorded responses from a JSONL file of {"prompt": ..., "responses": [DiagramData dicts]}."""
+    responses = {}
+    with open(path, "r") as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                responses[record["prompt"]] = record["responses"]
+    return responses
+
+def memory_vector_store():
+    """QdrantHandler over an in-memory collection of the services catalog, with fake embeddings."""
+    handler = QdrantHandler(DeterministicFakeEmbedding(size=FAKE_EMBEDDING_SIZE),
+                            location=":memory:",
+                            embedding_size=FAKE_EMBEDDING_SIZE)
+    handler.sync_documents(create_documents(SERVICES_FOLDER))
+    return handler
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    # Nearest-rank percentile
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+def _summary_ms(values):
+    return {"count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "max_ms": round(max(values, default=0) * 1000, 2)}
+
+def _timed_calls(func, items, repeat=1):
+    durations = []
+    for _ in range(repeat):
+        for item in items:
+            start = time.perf_counter()
+            func(item)
+            durations.append(time.perf_counter() - start)
+    return durations
+
+def configure_agent(model, vector_store, checkpoint_path, render_cache=True):
+    """Point the lazy providers of agent.agent at the benchmark doubles, before first use."""
+    agent_module.CHECKPOINT_PATH = checkpoint_path
+    agent_module.get_model = lambda: model
+    agent_module.get_repair_model = lambda: model
+    agent_module.get_vector_store = singleton(lambda: memory_vector_store() if vector_store == "memory" else None)
+    if not render_cache:
+        agent_module.get_render_pool = singleton(lambda: RenderPool(max_workers=agent_module.RENDER_WORKERS,
+                                                                    timeout=agent_module.RENDER_TIMEOUT,
+                                                                    queue_size=agent_module.RENDER_QUEUE_SIZE,
+                                                                    cache=None))
+
+def run_requests(prompts, concurrency):
+    def run(item):
+        i, prompt = item
+        start = time.perf_counter()
+        with trace_request() as trace:
+            agent_module.invoke(prompt, thread_id=f"benchmark-{os.getpid()}-{i}")
+            summary = trace.summary()
+        summary["latency"] = time.perf_counter() - start
+        return summary
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        summaries = list(executor.map(run, enumerate(prompts)))
+    return summaries, time.perf_counter() - start
+
+def request_report(summaries, wall_seconds):
+    nodes = {}
+    for summary in summaries:
+        for node in summary["nodes"]:
+            nodes.setdefault(node["node"], []).append(node["seconds"])
+    loops = [summary["loops"] for summary in summaries]
+    renders = len(nodes.get("create_diagram_image", []))
+    return {"requests": len(summaries),
+            "wall_seconds": round(wall_seconds, 3),
+            "latency": _summary_ms([summary["latency"] for summary in summaries]),
+            "nodes": {name: dict(_summary_ms(values), total_ms=round(sum(values) * 1000, 2)) for name, values in nodes.items()},
+            "repair_iterations": {"mean": round(sum(loops) / max(1, len(loops)), 3),
+                                  "max": max(loops, default=0),
+                                  "distribution": {str(n): loops.count(n) for n in sorted(set(loops))}},
+            "renders_per_second": round(renders / wall_seconds, 2) if wall_seconds else 0.0,
+            "llm_tokens": {"input": sum(summary.get("llm_input_tokens", 0) for summary in summaries),
+                           "output": sum(summary.get("llm_output_tokens", 0) for summary in summaries)}}
+
+def component_report(prompts, repeat):
+    """Time the steps that most often regress, outside the graph."""
+    responses = [scripted_responses(prompt, "clean")[0] for prompt in prompts]
+    import_codes = [response["import_code"] for response in responses]
+    broken = [import_code + "\nfrom diagrams.aws.compute import QuantumMainframe" for import_code in import_codes]
+    error_messages = [check_modules(import_code)[1] for import_code in broken]
+    retriever = agent_module.get_retriever()
+
+    report = {"check_modules": _summary_ms(_timed_calls(check_modules, import_codes + broken, repeat)),
+              "lint_body_code": _summary_ms(_timed_calls(lambda response: lint_body_code(response["import_code"], response["body_code"]),
+                                                         responses, repeat)),
+              "retrieval": _summary_ms(_timed_calls(retriever.query_batch, error_messages, repeat)),
+              "generate": _summary_ms(_timed_calls(lambda response: generate(response["import_code"], response["body_code"]),
+                                                   responses))}
+
+    # Uncached render throughput of the worker pool
+    pool = RenderPool(max_workers=agent_module.RENDER_WORKERS, timeout=agent_module.RENDER_TIMEOUT,
+                      queue_size=max(agent_module.RENDER_QUEUE_SIZE, len(responses)), cache=None)
+    try:
+        pool.warm_up()
+        start = time.perf_counter()
+        futures = [pool.submit(response["import_code"], response["body_code"]) for response in responses]
+        results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+    finally:
+        pool.shutdown()
+    report["render_pool"] = {"renders": len(results),
+                             "errors": len([result for result in results if result.error_message]),
+                             "renders_per_second": round(len(results) / elapsed, 2) if elapsed else 0.0}
+    return report
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return {"self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)}
+
+def gate_metrics(results):
+    """The flat metrics compared against a baseline."""
+    metrics = {"latency_p95_ms": results["agent"]["latency"]["p95_ms"]}
+    for name in ("check_modules", "lint_body_code", "retrieval", "generate"):
+        if name in results.get("components", {}):
+            metrics[f"{name}_p95_ms"] = results["components"][name]["p95_ms"]
+    if "render_pool" in results.get("components", {}):
+        metrics["render_pool_renders_per_second"] = results["components"]["render_pool"]["renders_per_second"]
+    return metrics
+
+def compare(results, baseline, tolerance):
+    """Regressions larger than tolerance (a fraction) against the gate metrics of baseline."""
+    regressions = []
+    current = gate_metrics(results)
+    for name, previous in gate_metrics(baseline).items():
+        value = current.get(name)
+        if value is None or not previous:
+            continue
+        change = (previous - value) / previous if name in HIGHER_IS_BETTER else (value - previous) / previous
+        if change > tolerance:
+            regressions.append(f"{name}: {previous} -> {value} ({change:+.0%})")
+    return regressions
+
+def print_report(results):
+    agent_results = results["agent"]
+    latency = agent_results["latency"]
+    print(f"Requests: {agent_results['requests']} in {agent_results['wall_seconds']}s "
+          f"(concurrency {results['config']['concurrency']}, scenario {results['config']['scenario']})")
+    print(f"End-to-end latency: p50 {latency['p50_ms']} ms, p95 {latency['p95_ms']} ms, max {latency['max_ms']} ms")
+    print(f"Repair iterations: mean {agent_results['repair_iterations']['mean']}, max {agent_results['repair_iterations']['max']}, "
+          f"distribution {agent_results['repair_iterations']['distribution']}")
+    print(f"Renders per second (graph): {agent_results['renders_per_second']}")
+    print("Per node:")
+    for name, node in sorted(agent_results["nodes"].items(), key=lambda item: -item[1]["total_ms"]):
+        print(f"  {name:<32} n={node['count']:<5} p50 {node['p50_ms']:>8} ms  p95 {node['p95_ms']:>8} ms  total {node['total_ms']:>9} ms")
+    if results.get("components"):
+        print("Components:")
+        for name, component in results["components"].items():
+            if name == "render_pool":
+                print(f"  {name:<32} {component['renders_per_second']} renders/s ({component['renders']} renders, {component['errors']} errors)")
+            else:
+                print(f"  {name:<32} n={component['count']:<5} p50 {component['p50_ms']:>8} ms  p95 {component['p95_ms']:>8} ms")
+    print(f"Peak RSS: {results['peak_rss_mb']['self']} MB (render workers {results['peak_rss_mb']['children']} MB)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the diagram agent.")
+    parser.add_argument("--prompts", default="requests.jsonl", help="JSONL corpus with a prompt, title or body field per line.")
+    parser.add_argument("--responses", help="JSONL of recorded responses: {\"prompt\": ..., \"responses\": [DiagramData, ...]}.")
+    parser.add_argument("--scenario", default="mixed", choices=SCENARIOS + ("mixed",),
+                        help="Which path the scripted responses exercise. mixed picks one per prompt.")
+    parser.add_argument("--limit", type=int, help="Only use the first N prompts.")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the corpus this many times.")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds the fake model sleeps per call.")
+    parser.add_argument("--vector-store", default="memory", choices=("memory", "none"))
+    parser.add_argument("--no-render-cache", action="store_true", help="Render every diagram, even when it was rendered before.")
+    parser.add_argument("--skip-components", action="store_true")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed regression against the baseline, as a fraction.")
+    parser.add_argument("--verbose", action="store_true", help="Keep the agent's own logs.")
+    args = parser.parse_args(argv)
+
+    prompts = load_prompts(args.prompts, args.limit)
+    if not prompts:
+        parser.error(f"No prompts found in {args.prompts}")
+    if args.scenario == "mixed":
+        scenario_for = lambda prompt: SCENARIOS[_seed(prompt) % len(SCENARIOS)]
+    else:
+        scenario_for = lambda prompt: args.scenario
+    recorded = load_recorded_responses(args.responses) if args.responses else None
+    model = FakeDiagramModel(recorded, scenario_for=scenario_for, latency=args.llm_latency)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        configure_agent(model, args.vector_store, os.path.join(tmpdir, "checkpoints.sqlite"),
+                        render_cache=not args.no_render_cache)
+        logs = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with logs:
+            agent_module.warm_up()
+            # Build the retriever, and the in-memory collection, before anything is timed
+            agent_module.get_retriever()
+            summaries, wall_seconds = run_requests(prompts * args.repeat, args.concurrency)
+            components = {} if args.skip_components else component_report(prompts, args.repeat)
+            agent_module.get_render_pool().shutdown()
+
+    results = {"config": {"prompts": args.prompts, "requests": len(prompts) * args.repeat, "scenario": args.scenario,
+                          "concurrency": args.concurrency, "vector_store": args.vector_store,
+                          "render_cache": not args.no_render_cache, "llm_latency": args.llm_latency},
+               "agent": request_report(summaries, wall_seconds),
+               "components": components,
+               "peak_rss_mb": peak_rss_mb()}
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        if baseline.get("config") != results["config"]:
+            print("Warning: the baseline was run with a different configuration.")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions against the baseline.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())